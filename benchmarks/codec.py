@@ -0,0 +1,334 @@
+from shared.packets import PACKET_TYPE_TO_CLASS, PacketType, Packet
+from shared.config import SHARED_CONFIG
+from shared.packet_socket import PacketSocket
+from shared.items import Relation, Message
+
+import tracemalloc
+import threading
+import argparse
+import select
+import socket
+import queue
+import json
+import time
+import sys
+import os
+
+
+# how many items (messages, relations, usernames, content bytes) a packet of each size has
+SIZES = {"small": 10, "medium": 1_000, "huge": 100_000}
+OPERATIONS = ["encode", "decode", "frame"]
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(__file__), "codec_baseline.json")
+
+
+def _make_messages(count: int) -> list[Message]:
+    return [
+        Message(
+            index, "alice", "bob", 1_700_000_000 + index, "hello there, how are you?"
+        )
+        for index in range(count)
+    ]
+
+
+def _make_relations(count: int) -> list[Relation]:
+    return [
+        Relation("alice", f"friend{index}", True, index % 2 == 0, False)
+        for index in range(count)
+    ]
+
+
+def _make_packet(packet_type: PacketType, count: int) -> Packet | None:
+    # None for the sizes a packet doesn't have, its contents don't grow
+    packet = PACKET_TYPE_TO_CLASS[packet_type](1)
+    sized = count != SIZES["small"]
+    match packet_type:
+        case PacketType.client_authenticate:
+            if sized:
+                return None
+            packet.init_packet_from_params("x" * 16)  # type: ignore
+        case PacketType.client_resume_session:
+            if sized:
+                return None
+            packet.init_packet_from_params(os.urandom(64))  # type: ignore
+        case PacketType.client_get_messages:
+            if sized:
+                return None
+            packet.init_packet_from_params("bob", 12345)  # type: ignore
+        case PacketType.client_add_friend | PacketType.client_remove_friend:
+            if sized:
+                return None
+            packet.init_packet_from_params("bob")  # type: ignore
+        case PacketType.client_update_friends:
+            packet.init_packet_from_params([f"friend{index}" for index in range(count)], True)  # type: ignore
+        case PacketType.client_send_message:
+            packet.init_packet_from_params("bob", "x" * count, os.urandom(SHARED_CONFIG["packets"]["idempotency_key_bytes"]))  # type: ignore
+        case PacketType.invalid_packet_type:
+            if sized:
+                return None
+            packet.init_packet_from_params(list(PacketType))  # type: ignore
+        case PacketType.server_authenticate:
+            if sized:
+                return None
+            packet.init_packet_from_params(True, "alice", os.urandom(64))  # type: ignore
+        case PacketType.server_get_relations:
+            packet.init_packet_from_params(_make_relations(count))  # type: ignore
+        case PacketType.server_get_messages | PacketType.server_new_message:
+            packet.init_packet_from_params(_make_messages(count))  # type: ignore
+        case PacketType.server_add_friend:
+            if sized:
+                return None
+            packet.init_packet_from_params(True)  # type: ignore
+        case PacketType.server_update_friends:
+            packet.init_packet_from_params([index % 2 == 0 for index in range(count)])  # type: ignore
+        case PacketType.server_send_message:
+            if sized:
+                return None
+            packet.init_packet_from_params(12345)  # type: ignore
+        case _:
+            # empty packets
+            if sized:
+                return None
+    return packet
+
+
+class _SocketPair:
+    # packet sockets on both ends of a local tcp connection
+    def __init__(self) -> None:
+        listener = socket.create_server(("127.0.0.1", 0))
+        self.__client_sock = socket.create_connection(listener.getsockname())
+        self.__server_sock = listener.accept()[0]
+        listener.close()
+        for sock in [self.__client_sock, self.__server_sock]:
+            sock.setblocking(False)
+
+        self.sender = PacketSocket(self.__client_sock)
+        self.receiver = PacketSocket(self.__server_sock)
+
+        # sends from another thread like a real peer, the same one every time so starting
+        # it isn't part of what is measured. (packet, how many times), None to stop
+        self.__send_jobs: queue.Queue[tuple[Packet, int] | None] = queue.Queue()
+        self.__send_jobs_done = threading.Semaphore(0)
+        self.__sender_thread = threading.Thread(
+            target=self.__send_packets, name="CodecBenchmarkSender", daemon=True
+        )
+        self.__sender_thread.start()
+
+    def send_from_other_thread(self, packet: Packet, number: int) -> None:
+        self.__send_jobs.put((packet, number))
+
+    def wait_for_sending(self) -> None:
+        self.__send_jobs_done.acquire()
+
+    def __send_packets(self) -> None:
+        while True:
+            send_job = self.__send_jobs.get()
+            if send_job == None:
+                return
+
+            packet, number = send_job
+            for _ in range(number):
+                self.sender.send(packet)
+            self.__send_jobs_done.release()
+
+    def recv(self) -> Packet:
+        while True:
+            try:
+                return self.receiver.recv()
+            except BlockingIOError:
+                select.select([self.receiver.raising_socket], [], [])
+
+    def close(self) -> None:
+        self.__send_jobs.put(None)
+        self.__sender_thread.join()
+        for packet_sock in [self.sender, self.receiver]:
+            packet_sock.raising_socket.close()
+        self.__client_sock.close()
+        self.__server_sock.close()
+
+
+def _make_operation(operation: str, packet: Packet, socket_pair: _SocketPair):
+    # returns a function that does the operation a given number of times
+    data = packet.compile()[
+        SHARED_CONFIG["packets"]["packet_id_bytes"]
+        + SHARED_CONFIG["packets"]["packet_type_bytes"]
+        + SHARED_CONFIG["packets"]["packet_data_length_bytes"] :
+    ]
+    packet_class = type(packet)
+
+    def encode(number: int) -> None:
+        for _ in range(number):
+            packet.compile()
+
+    def decode(number: int) -> None:
+        for _ in range(number):
+            packet_class(1).init_packet_from_data(data)
+
+    def frame(number: int) -> None:
+        # the whole way through a socket
+        socket_pair.send_from_other_thread(packet, number)
+        for _ in range(number):
+            socket_pair.recv()
+        socket_pair.wait_for_sending()
+
+    return {"encode": encode, "decode": decode, "frame": frame}[operation]
+
+
+def _measure(run, min_time: float, repeat: int) -> tuple[float, int]:
+    # the best of a few runs, each long enough for the clock to be precise
+    number = 1
+    while True:
+        start_time = time.perf_counter()
+        run(number)
+        elapsed_time = time.perf_counter() - start_time
+        if elapsed_time >= min_time:
+            break
+        number *= 10 if elapsed_time < min_time / 10 else 2
+
+    best_time = elapsed_time
+    for _ in range(repeat - 1):
+        start_time = time.perf_counter()
+        run(number)
+        best_time = min(best_time, time.perf_counter() - start_time)
+
+    # the most memory a single run had allocated at once
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+        run(1)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return best_time / number * 1e9, peak_memory - start_memory
+
+
+def run_benchmarks(
+    sizes: list[str], name_filter: str, min_time: float, repeat: int
+) -> dict[str, dict]:
+    results = {}
+    socket_pair = _SocketPair()
+    try:
+        for packet_type in PACKET_TYPE_TO_CLASS:
+            for size in sizes:
+                packet = _make_packet(packet_type, SIZES[size])
+                if packet == None:
+                    continue
+
+                for operation in OPERATIONS:
+                    name = f"{packet_type.name}/{size}/{operation}"
+                    if name_filter not in name:
+                        continue
+
+                    ns_per_op, allocated_bytes = _measure(
+                        _make_operation(operation, packet, socket_pair),
+                        min_time,
+                        repeat,
+                    )
+                    results[name] = {
+                        "ns_per_op": ns_per_op,
+                        "bytes_per_op": len(packet.compile()),
+                        "allocated_bytes_per_op": allocated_bytes,
+                    }
+                    print(
+                        f"{name:<48} {ns_per_op:>16,.0f} ns/op {results[name]['bytes_per_op']:>12,} B/op {allocated_bytes:>14,} B allocated",
+                        file=sys.stderr,
+                    )
+    finally:
+        socket_pair.close()
+
+    return results
+
+
+def find_regressions(
+    results: dict[str, dict], baseline: dict[str, dict], threshold: float
+) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        keys = ["ns_per_op", "allocated_bytes_per_op"]
+        if name.endswith("/frame"):
+            # both threads allocate at the same time, so the peak depends on how they
+            # happened to take turns
+            keys.remove("allocated_bytes_per_op")
+        for key in keys:
+            # a few bytes either way is noise, not a regression
+            if (
+                result[key] > baseline[name][key] * (1 + threshold)
+                and result[key] - baseline[name][key] > 64
+            ):
+                regressions.append(
+                    f"{name} {key}: {baseline[name][key]:,.0f} -> {result[key]:,.0f} ({result[key] / max(baseline[name][key], 1) - 1:+.0%})"
+                )
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measures encoding, decoding and framing every packet type"
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        choices=list(SIZES.keys()),
+        default=list(SIZES.keys()),
+    )
+    parser.add_argument(
+        "--filter", default="", help="only the benchmarks with this in their name"
+    )
+    parser.add_argument(
+        "--min-time", type=float, default=0.1, help="in seconds, per measurement"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="save the results as the baseline instead of comparing to it",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="how much slower (or more allocating) than the baseline is a regression",
+    )
+    parser.add_argument("--output", help="file to write the json results to")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.filter, args.min_time, args.repeat)
+
+    if args.output != None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.save_baseline:
+        # other results in the baseline are kept, so it can be saved bit by bit
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        baseline.update(results)
+        with open(args.baseline, "w") as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}", file=sys.stderr)
+        return
+
+    if not os.path.exists(args.baseline):
+        print(
+            "No baseline to compare to, save one with --save-baseline",
+            file=sys.stderr,
+        )
+        return
+
+    with open(args.baseline) as file:
+        regressions = find_regressions(results, json.load(file), args.threshold)
+    if len(regressions) > 0:
+        print("Regressions:", *regressions, sep="\n  ", file=sys.stderr)
+        sys.exit(1)
+    print("No regressions", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
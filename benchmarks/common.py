@@ -0,0 +1,32 @@
+from typing import Sequence
+
+import subprocess
+
+
+def percentile(sorted_values: Sequence[float], percentile: float) -> float:
+    if len(sorted_values) == 0:
+        return 0
+    # nearest rank
+    rank = max(int(len(sorted_values) * percentile / 100 + 0.5), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize_latencies(latencies: Sequence[float]) -> dict[str, float]:
+    # latencies in seconds, summarized in milliseconds
+    latencies = sorted(latencies)
+    return {
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": (latencies[-1] if len(latencies) > 0 else 0) * 1000,
+    }
+
+
+def get_commit() -> str | None:
+    # so results can be matched to the code they were measured on
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
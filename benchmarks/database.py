@@ -0,0 +1,397 @@
+from shared.config import SERVER_CONFIG
+from server.db_handler import DBWrapper, SQLITE3_TRUE, SQLITE3_FALSE
+from .common import summarize_latencies, get_commit
+
+import itertools
+import argparse
+import tempfile
+import hashlib
+import sqlite3
+import random
+import json
+import time
+import sys
+import re
+import os
+
+
+# literals in traced statements, so statements that only differ by them are grouped.
+# sqlite traces blobs as x'..', which has to match before the plain string would
+LITERAL_PATTERN = re.compile(r"\b[xX]'[0-9A-Fa-f]*'|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+WORDS = "hey hi hello what are you doing tonight lol ok sure see you later did you see that yeah no maybe why".split()
+
+
+def _get_username(index: int) -> str:
+    return f"user{index}"
+
+
+def _get_token(index: int) -> str:
+    return f"token{index}"
+
+
+class SyntheticDataset:
+    def __init__(
+        self,
+        users: int,
+        messages: int,
+        mean_friends: float,
+        power_law_exponent: float,
+        rng: random.Random,
+    ) -> None:
+        self.__users = users
+        self.__messages = messages
+        self.__mean_friends = mean_friends
+        self.__power_law_exponent = power_law_exponent
+        self.__rng = rng
+
+        # a few users are very popular and most aren't, like in real social graphs
+        self.__popularity_weights = list(
+            itertools.accumulate(
+                [
+                    1 / (rank + 1) ** (1 / (power_law_exponent - 1))
+                    for rank in range(users)
+                ]
+            )
+        )
+        self.friendships: list[tuple[int, int]] = []
+
+    def generate(self, path: str) -> None:
+        DBWrapper().ensure_tables()
+        conn = sqlite3.connect(path)
+        # nothing to lose if it breaks halfway, it would just be made again
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+
+        conn.executemany(
+            "INSERT INTO users (username, token_hash) VALUES (?, ?)",
+            (
+                [
+                    _get_username(index),
+                    hashlib.sha512(_get_token(index).encode()).digest(),
+                ]
+                for index in range(self.__users)
+            ),
+        )
+        self.__make_friendships()
+        conn.executemany(
+            "INSERT INTO relations (first_user, secondary_user, first_is_friend, secondary_is_friend, secondary_is_blocked) VALUES (?, ?, ?, ?, ?)",
+            self.__generate_relation_rows(),
+        )
+        conn.executemany(
+            "INSERT INTO messages (sender_username, receiver_username, content, time_sent, idempotency_key) VALUES (?, ?, ?, ?, ?)",
+            self.__generate_message_rows(),
+        )
+        conn.commit()
+        conn.close()
+
+    def __pick_popular_user(self) -> int:
+        return self.__rng.choices(
+            range(self.__users), cum_weights=self.__popularity_weights
+        )[0]
+
+    def __make_friendships(self) -> None:
+        # every user has a power law distributed number of friends, picked by popularity
+        seen_pairs = set()
+        minimum_friends = (
+            self.__mean_friends
+            * (self.__power_law_exponent - 2)
+            / (self.__power_law_exponent - 1)
+        )
+        for user in range(self.__users):
+            friend_count = min(
+                int(
+                    minimum_friends
+                    * self.__rng.paretovariate(self.__power_law_exponent - 1)
+                    / 2
+                ),
+                self.__users - 1,
+            )
+            for _ in range(friend_count):
+                friend = self.__pick_popular_user()
+                pair = (min(user, friend), max(user, friend))
+                if friend == user or pair in seen_pairs:
+                    continue
+                seen_pairs.add(pair)
+                self.friendships.append(pair)
+
+    def __generate_relation_rows(self):
+        for first_user, secondary_user in self.friendships:
+            # most are accepted, some are still pending
+            is_accepted = self.__rng.random() < 0.9
+            yield [
+                _get_username(first_user),
+                _get_username(secondary_user),
+                SQLITE3_TRUE,
+                SQLITE3_TRUE if is_accepted else SQLITE3_FALSE,
+                SQLITE3_FALSE,
+            ]
+            yield [
+                _get_username(secondary_user),
+                _get_username(first_user),
+                SQLITE3_TRUE if is_accepted else SQLITE3_FALSE,
+                SQLITE3_TRUE,
+                SQLITE3_FALSE,
+            ]
+
+    def __generate_message_rows(self):
+        if len(self.friendships) == 0:
+            return
+
+        # some conversations are much busier than others
+        conversation_weights = list(
+            itertools.accumulate(
+                [self.__rng.paretovariate(1.2) for _ in self.friendships]
+            )
+        )
+        time_sent = int(time.time()) - self.__messages
+        for _ in range(self.__messages):
+            first_user, secondary_user = self.__rng.choices(
+                self.friendships, cum_weights=conversation_weights
+            )[0]
+            if self.__rng.random() < 0.5:
+                first_user, secondary_user = secondary_user, first_user
+            time_sent += 1
+            yield [
+                _get_username(first_user),
+                _get_username(secondary_user),
+                " ".join(self.__rng.choices(WORDS, k=self.__rng.randint(1, 20))),
+                time_sent,
+                self.__rng.randbytes(16),
+            ]
+
+
+class DatabaseBenchmark:
+    def __init__(
+        self,
+        db_wrapper: DBWrapper,
+        friendships: list[tuple[str, str]],
+        users: int,
+        newest_message_id: int,
+        iterations: int,
+        rng: random.Random,
+    ) -> None:
+        self.__db_wrapper = db_wrapper
+        self.__friendships = friendships
+        self.__users = users
+        self.__newest_message_id = newest_message_id
+        self.__iterations = iterations
+        self.__rng = rng
+
+        # normalized statement -> (method, an example of it)
+        self.__statements: dict[str, tuple[str, str]] = {}
+        self.__current_method = ""
+        self.__db_wrapper.set_trace_callback(self.__trace_statement)
+
+    def run(self) -> dict[str, dict]:
+        methods = {
+            "ensure_tables": lambda: self.__db_wrapper.ensure_tables(),
+            "check_user_exists": lambda: self.__db_wrapper.check_user_exists(
+                _get_username(self.__random_user())
+            ),
+            "check_token": lambda: self.__db_wrapper.check_token(
+                _get_token(self.__random_user())
+            ),
+            "get_relation": lambda: self.__db_wrapper.get_relation(
+                *self.__random_friendship()
+            ),
+            "get_all_relations": lambda: self.__db_wrapper.get_all_relations(
+                _get_username(self.__random_user())
+            ),
+            "get_messages": lambda: self.__db_wrapper.get_messages(
+                *self.__random_friendship(), 0
+            ),
+            "get_messages_recent": lambda: self.__db_wrapper.get_messages(
+                *self.__random_friendship(),
+                # the newest messages, like a client that is mostly up to date
+                max(self.__newest_message_id - 100, 0),
+            ),
+            "add_message": lambda: self.__db_wrapper.add_message(
+                *self.__random_friendship(),
+                "benchmark message",
+                os.urandom(16),
+            ),
+            "add_friend": lambda: self.__db_wrapper.add_friend(
+                *self.__random_friendship()
+            ),
+            "remove_friend": lambda: self.__db_wrapper.remove_friend(
+                *self.__random_friendship()
+            ),
+            "update_friends": lambda: self.__db_wrapper.update_friends(
+                _get_username(self.__random_user()),
+                [_get_username(self.__random_user()) for _ in range(10)],
+                self.__rng.random() < 0.5,
+            ),
+            "add_user": lambda: self.__db_wrapper.add_user(
+                f"newuser{next(self.__new_user_indexes)}"
+            ),
+        }
+        self.__new_user_indexes = itertools.count()
+
+        results = {}
+        for method_name, method in methods.items():
+            self.__current_method = method_name
+            latencies = []
+            for _ in range(self.__iterations):
+                start_time = time.perf_counter()
+                method()
+                latencies.append(time.perf_counter() - start_time)
+            results[method_name] = {
+                "calls": len(latencies),
+                "mean_ms": sum(latencies) / len(latencies) * 1000,
+                **summarize_latencies(latencies),
+            }
+            print(
+                f"{method_name:<24} {results[method_name]['p50_ms']:>12.3f} ms p50 {results[method_name]['p99_ms']:>12.3f} ms p99",
+                file=sys.stderr,
+            )
+        self.__current_method = ""
+
+        return results
+
+    def explain_statements(self, path: str) -> list[dict]:
+        conn = sqlite3.connect(path)
+        query_plans = []
+        for normalized_statement, (method_name, statement) in self.__statements.items():
+            try:
+                plan = [
+                    row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {statement}")
+                ]
+            except sqlite3.Error as error:
+                plan = [f"can't explain: {error}"]
+            query_plans.append(
+                {
+                    "method": method_name,
+                    "statement": normalized_statement,
+                    "plan": plan,
+                    # a scan reads the whole table, unlike a search which uses an index
+                    "full_scan": any(
+                        step.startswith("SCAN")
+                        and "USING" not in step
+                        and "VIRTUAL TABLE" not in step
+                        for step in plan
+                    ),
+                }
+            )
+        conn.close()
+        return query_plans
+
+    def __trace_statement(self, statement: str) -> None:
+        # sqlite also traces what it runs on its own, as comments
+        if (
+            self.__current_method == ""
+            or statement in ["BEGIN ", "COMMIT", "ROLLBACK"]
+            or statement.startswith("--")
+        ):
+            return
+        normalized_statement = LITERAL_PATTERN.sub("?", " ".join(statement.split()))
+        self.__statements.setdefault(
+            normalized_statement, (self.__current_method, statement)
+        )
+
+    def __random_user(self) -> int:
+        return self.__rng.randrange(self.__users)
+
+    def __random_friendship(self) -> tuple[str, str]:
+        if len(self.__friendships) == 0:
+            return (_get_username(0), _get_username(1))
+        return self.__rng.choice(self.__friendships)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Times every DBWrapper method on a big synthetic database, and shows the query plans of their statements"
+    )
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument(
+        "--messages", type=int, default=1_000_000, help="tens of millions work, slowly"
+    )
+    parser.add_argument("--mean-friends", type=float, default=20)
+    parser.add_argument(
+        "--power-law-exponent",
+        type=float,
+        default=2.5,
+        help="of the friend counts, smaller makes the popular users more popular",
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=200, help="calls timed per method"
+    )
+    parser.add_argument(
+        "--database",
+        help="where to keep the dataset, it is only generated if the file doesn't exist yet (temporary by default)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the json to, stdout by default")
+    args = parser.parse_args()
+
+    if args.users < 2:
+        parser.error("at least 2 users are needed")
+    if args.power_law_exponent <= 2:
+        parser.error("the power law exponent must be more than 2")
+
+    with tempfile.TemporaryDirectory(prefix="objectivechat-db-benchmark-") as directory:
+        path = args.database or os.path.join(directory, "database.db")
+        SERVER_CONFIG["database"]["filepath"] = path
+        rng = random.Random(args.seed)
+
+        generation_time = None
+        if not os.path.exists(path):
+            print("Generating the dataset", file=sys.stderr)
+            start_time = time.perf_counter()
+            SyntheticDataset(
+                args.users,
+                args.messages,
+                args.mean_friends,
+                args.power_law_exponent,
+                rng,
+            ).generate(path)
+            generation_time = time.perf_counter() - start_time
+
+        conn = sqlite3.connect(path)
+        friendships = conn.execute(
+            "SELECT first_user, secondary_user FROM relations WHERE first_user < secondary_user"
+        ).fetchall()
+        newest_message_id = (
+            conn.execute("SELECT max(rowid) FROM messages").fetchone()[0] or 0
+        )
+        conn.close()
+
+        benchmark = DatabaseBenchmark(
+            DBWrapper(),
+            friendships,
+            args.users,
+            newest_message_id,
+            args.iterations,
+            rng,
+        )
+        methods = benchmark.run()
+        query_plans = benchmark.explain_statements(path)
+
+    for query_plan in query_plans:
+        if query_plan["full_scan"]:
+            print(
+                f"Full table scan in {query_plan['method']}: {query_plan['statement']}",
+                file=sys.stderr,
+            )
+
+    report = {
+        "commit": get_commit(),
+        "parameters": vars(args),
+        "dataset": {
+            "friendships": len(friendships),
+            "messages": newest_message_id,
+            "generation_seconds": generation_time,
+        },
+        "methods": methods,
+        "query_plans": query_plans,
+    }
+    if args.output == None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
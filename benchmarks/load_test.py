@@ -0,0 +1,550 @@
+from typing import Sequence
+
+from shared.packets import ClientPackets, SharedPackets, PacketType, Packet
+from shared.config import SERVER_CONFIG, SHARED_CONFIG
+from shared.packet_socket import PacketSocket
+from server.db_handler import DBWrapper
+from server import Server
+from .common import summarize_latencies, get_commit
+
+import tracemalloc
+import threading
+import argparse
+import tempfile
+import logging
+import random
+import socket
+import array
+import json
+import time
+import sys
+import os
+
+
+OPERATIONS = ["send", "history", "friends"]
+
+
+class BenchmarkClient:
+    # a simulated user, speaking the wire protocol directly so only the server is measured
+    def __init__(self, address: tuple[str, int], token: str) -> None:
+        self.__sock = socket.create_connection(address)
+        self.__packet_sock = PacketSocket(self.__sock)
+        # blocking, but not forever if the server stops answering
+        self.__packet_sock.raising_socket.settimeout(
+            SERVER_CONFIG["connection"]["authentication_timeout"]
+        )
+
+        auth_packet = ClientPackets.Authenticate()
+        auth_packet.init_packet_from_params(token)
+        response = self.request(auth_packet)
+        if not response.success:  # type: ignore
+            raise ConnectionError("benchmark user failed to authenticate")
+        self.username: str = response.username  # type: ignore
+
+    def request(self, packet: Packet) -> Packet:
+        self.__packet_sock.send(packet)
+        while True:
+            response = self.__packet_sock.recv()
+            # pushes from other users' actions come in between
+            if response.id != packet.id or response.type in [
+                PacketType.server_new_message,
+                PacketType.server_relations_changed,
+            ]:
+                continue
+            if response.type == PacketType.invalid_packet_type:
+                raise ValueError(f"server rejected {packet.type.name}")
+            return response
+
+    def close(self) -> None:
+        try:
+            self.__packet_sock.send(SharedPackets.Quit())
+        except OSError:
+            pass
+        self.__packet_sock.raising_socket.close()
+        self.__sock.close()
+
+
+def _get_rss_bytes() -> int | None:
+    # linux only, None elsewhere
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+class ResourceMonitor:
+    # samples the process (server included) while a soak test runs, leaks show up
+    # as something that keeps growing after the warmup
+    def __init__(
+        self,
+        sample_interval: float,
+        warmup: float,
+        budgets: dict[str, float],
+        top_allocators: int = 10,
+    ) -> None:
+        self.__sample_interval = sample_interval
+        self.__warmup = warmup
+        # sample key -> how much it may grow from the end of the warmup to after the
+        # load, threads and sessions may not grow at all
+        self.__budgets = budgets
+        self.__top_allocators = top_allocators
+
+        self.__samples: list[dict] = []
+        self.__baseline_sample = None
+        self.__baseline_snapshot = None
+        self.__stop_event = threading.Event()
+
+    def start(self, server: Server) -> None:
+        self.__server = server
+        tracemalloc.start()
+        self.__start_time = time.perf_counter()
+        self.__thread = threading.Thread(
+            target=self.__sample_periodically, name="ResourceMonitor", daemon=True
+        )
+        self.__thread.start()
+        # with the monitor's own thread, before any client connected
+        self.__threads_before_load = threading.active_count()
+
+    def stop(self, settle_timeout: float = 10) -> dict:
+        # the clients must be gone by now, their sessions should end and take
+        # their threads with them
+        max_settle_time = time.perf_counter() + settle_timeout
+        while time.perf_counter() < max_settle_time and (
+            len(self.__server.clients) > 0
+            or threading.active_count() > self.__threads_before_load
+        ):
+            time.sleep(0.1)
+        threads_after_load = threading.active_count()
+        sessions_after_load = len(self.__server.clients)
+
+        self.__stop_event.set()
+        self.__thread.join()
+        final_sample, final_snapshot = self.__take_sample()
+        self.__samples.append(final_sample)
+        tracemalloc.stop()
+
+        failures = []
+        if threads_after_load > self.__threads_before_load:
+            failures.append(
+                f"{threads_after_load - self.__threads_before_load} threads were left running after every client disconnected"
+            )
+        if sessions_after_load > 0:
+            failures.append(
+                f"{sessions_after_load} sessions were left on the server after every client disconnected"
+            )
+
+        growth = {}
+        top_allocators = []
+        if self.__baseline_sample == None:
+            failures.append("the test ended before the warmup did, nothing to compare")
+        else:
+            for key, budget in self.__budgets.items():
+                if final_sample[key] == None or self.__baseline_sample[key] == None:
+                    continue
+                growth[key] = final_sample[key] - self.__baseline_sample[key]
+                if growth[key] > budget:
+                    failures.append(
+                        f"{key} grew by {growth[key]:,} after the warmup, the budget is {budget:,}"
+                    )
+            top_allocators = [
+                {
+                    "location": str(statistic.traceback[0]),
+                    "size_diff_bytes": statistic.size_diff,
+                    "count_diff": statistic.count_diff,
+                }
+                for statistic in final_snapshot.compare_to(
+                    self.__baseline_snapshot, "lineno"  # type: ignore
+                )[: self.__top_allocators]
+            ]
+
+        return {
+            "threads_before_load": self.__threads_before_load,
+            "threads_after_load": threads_after_load,
+            "sessions_after_load": sessions_after_load,
+            "baseline": self.__baseline_sample,
+            "growth": growth,
+            "budgets": self.__budgets,
+            "top_allocators": top_allocators,
+            "samples": self.__samples,
+            "failures": failures,
+        }
+
+    def __sample_periodically(self) -> None:
+        while not self.__stop_event.wait(self.__sample_interval):
+            sample, snapshot = self.__take_sample()
+            self.__samples.append(sample)
+            if self.__baseline_sample == None and sample["time"] >= self.__warmup:
+                # caches and pools have filled up by now, growth after this is suspicious
+                self.__baseline_sample = sample
+                self.__baseline_snapshot = snapshot
+            print(
+                f"{sample['time']:>8.0f} s {(sample['rss_bytes'] or 0) / 2**20:>10.1f} MiB rss {sample['traced_bytes'] / 2**20:>10.1f} MiB traced {sample['threads']:>6} threads {sample['sessions']:>6} sessions",
+                file=sys.stderr,
+            )
+
+    def __take_sample(self) -> tuple[dict, tracemalloc.Snapshot]:
+        # without what tracemalloc and the load test itself allocate, the latencies
+        # it keeps grow with every request
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            ]
+        )
+        sample = {
+            "time": time.perf_counter() - self.__start_time,
+            "rss_bytes": _get_rss_bytes(),
+            "traced_bytes": sum(
+                statistic.size for statistic in snapshot.statistics("filename")
+            ),
+            "threads": threading.active_count(),
+            "sessions": len(self.__server.clients),
+            "loggers": len(logging.root.manager.loggerDict),
+        }
+        return sample, snapshot
+
+
+class LoadTest:
+    def __init__(
+        self,
+        users: int,
+        clients: int,
+        duration: float,
+        mix: dict[str, int],
+        message_size: int,
+        history_size: int,
+        reconnect_every: int = 0,
+        monitor: ResourceMonitor | None = None,
+    ) -> None:
+        self.__users = users
+        self.__clients = clients
+        self.__duration = duration
+        self.__mix = mix
+        self.__message_size = message_size
+        self.__history_size = history_size
+        # requests made on a connection before it's replaced with a new one, 0 never does
+        self.__reconnect_every = reconnect_every
+        self.__monitor = monitor
+
+        # operation -> latencies in seconds, packed so a soak test's millions of them
+        # don't look like a leak
+        self.__latencies: dict[str, array.array] = {
+            operation: array.array("d") for operation in OPERATIONS
+        }
+        self.__errors: dict[str, int] = {operation: 0 for operation in OPERATIONS}
+        self.__reconnects = 0
+        self.__reconnect_errors = 0
+        self.__results_lock = threading.Lock()
+        # the newest message id seen by anyone, history fetches ask for the messages after a bit before it
+        self.__newest_message_id = 0
+
+    def run(self) -> dict:
+        with tempfile.TemporaryDirectory(
+            prefix="objectivechat-benchmark-"
+        ) as directory:
+            address = self.__start_server(directory)
+            tokens = self.__provision_users()
+            usernames = [f"benchuser{index}" for index in range(self.__users)]
+            if self.__monitor != None:
+                self.__monitor.start(self.__server)
+
+            clients = [
+                BenchmarkClient(address, tokens[index % len(tokens)])
+                for index in range(self.__clients)
+            ]
+            start_time = time.perf_counter()
+            end_time = start_time + self.__duration
+            threads = [
+                threading.Thread(
+                    target=self.__drive_client,
+                    args=[
+                        client,
+                        address,
+                        tokens[index % len(tokens)],
+                        usernames,
+                        end_time,
+                        random.Random(index),
+                    ],
+                    name=f"BenchmarkClient-{index}",
+                )
+                for index, client in enumerate(clients)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed_time = time.perf_counter() - start_time
+
+            soak_report = None
+            if self.__monitor != None:
+                soak_report = self.__monitor.stop()
+            self.__server.stop(send_quit=False)
+
+        report = self.__make_report(elapsed_time)
+        if soak_report != None:
+            report["soak"] = soak_report
+        return report
+
+    def __start_server(self, directory: str) -> tuple[str, int]:
+        SERVER_CONFIG["database"]["filepath"] = os.path.join(directory, "database.db")
+        SERVER_CONFIG["connection"]["listen_address"] = "127.0.0.1"
+        SERVER_CONFIG["connection"]["listen_port"] = 0  # any free port
+        SERVER_CONFIG["connection"]["accept_backlog"] = max(
+            SERVER_CONFIG["connection"]["accept_backlog"], self.__clients
+        )
+
+        self.__server = Server()
+        threading.Thread(
+            target=self.__server.run, name="BenchmarkServer", daemon=True
+        ).start()
+        return self.__server.address
+
+    def __provision_users(self) -> list[str]:
+        db_wrapper = DBWrapper()
+        tokens = []
+        for index in range(self.__users):
+            token, _ = db_wrapper.add_user(f"benchuser{index}")
+            tokens.append(token)
+        return tokens  # type: ignore
+
+    def __drive_client(
+        self,
+        client: BenchmarkClient,
+        address: tuple[str, int],
+        token: str,
+        usernames: list[str],
+        end_time: float,
+        rng: random.Random,
+    ) -> None:
+        operations = list(self.__mix.keys())
+        weights = list(self.__mix.values())
+        other_usernames = [
+            username for username in usernames if username != client.username
+        ]
+
+        requests_on_connection = 0
+        try:
+            while time.perf_counter() < end_time:
+                if 0 < self.__reconnect_every <= requests_on_connection:
+                    client.close()
+                    try:
+                        client = BenchmarkClient(address, token)
+                    except OSError:
+                        with self.__results_lock:
+                            self.__reconnect_errors += 1
+                        time.sleep(0.1)
+                        continue
+                    with self.__results_lock:
+                        self.__reconnects += 1
+                    requests_on_connection = 0
+                requests_on_connection += 1
+
+                operation = rng.choices(operations, weights)[0]
+                packet = self.__make_request(
+                    operation, rng.choice(other_usernames), rng
+                )
+
+                start_time = time.perf_counter()
+                try:
+                    response = client.request(packet)
+                except (OSError, ValueError):
+                    with self.__results_lock:
+                        self.__errors[operation] += 1
+                    continue
+                latency = time.perf_counter() - start_time
+
+                with self.__results_lock:
+                    self.__latencies[operation].append(latency)
+                    if operation == "send":
+                        self.__newest_message_id = max(
+                            self.__newest_message_id, response.message_id  # type: ignore
+                        )
+        finally:
+            client.close()
+
+    def __make_request(
+        self, operation: str, other_username: str, rng: random.Random
+    ) -> Packet:
+        match operation:
+            case "send":
+                packet = ClientPackets.SendMessage()
+                packet.init_packet_from_params(
+                    other_username,
+                    "x" * self.__message_size,
+                    os.urandom(SHARED_CONFIG["packets"]["idempotency_key_bytes"]),
+                )
+            case "history":
+                packet = ClientPackets.GetMessages()
+                packet.init_packet_from_params(
+                    other_username,
+                    max(self.__newest_message_id - self.__history_size, 0),
+                )
+            case "friends":
+                packet = (
+                    ClientPackets.AddFriend()
+                    if rng.random() < 0.5
+                    else ClientPackets.RemoveFriend()
+                )
+                packet.init_packet_from_params(other_username)
+            case _:
+                raise ValueError(f"unknown operation '{operation}'")
+        return packet
+
+    def __make_report(self, elapsed_time: float) -> dict:
+        all_latencies = [
+            latency for latencies in self.__latencies.values() for latency in latencies
+        ]
+        return {
+            "commit": get_commit(),
+            "parameters": {
+                "users": self.__users,
+                "clients": self.__clients,
+                "duration": self.__duration,
+                "mix": self.__mix,
+                "message_size": self.__message_size,
+                "history_size": self.__history_size,
+                "reconnect_every": self.__reconnect_every,
+            },
+            "elapsed_seconds": elapsed_time,
+            "reconnects": self.__reconnects,
+            "reconnect_errors": self.__reconnect_errors,
+            "total": _summarize(
+                all_latencies, sum(self.__errors.values()), elapsed_time
+            ),
+            "operations": {
+                operation: _summarize(
+                    self.__latencies[operation], self.__errors[operation], elapsed_time
+                )
+                for operation in OPERATIONS
+                if operation in self.__mix
+            },
+        }
+
+
+def _summarize(latencies: Sequence[float], errors: int, elapsed_time: float) -> dict:
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed_time,
+        **summarize_latencies(latencies),
+    }
+
+
+def _parse_mix(mix: str) -> dict[str, int]:
+    # "send=70,history=25,friends=5"
+    parsed_mix = {}
+    for part in mix.split(","):
+        operation, weight = part.split("=")
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation '{operation}'")
+        parsed_mix[operation] = int(weight)
+    return parsed_mix
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Runs a local server on a temporary database and measures it under load"
+    )
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument(
+        "--clients", type=int, default=20, help="concurrent connections"
+    )
+    parser.add_argument("--duration", type=float, default=10, help="in seconds")
+    parser.add_argument(
+        "--mix",
+        type=_parse_mix,
+        default="send=70,history=25,friends=5",
+        help="relative weights of the operations",
+    )
+    parser.add_argument("--message-size", type=int, default=64, help="in bytes")
+    parser.add_argument(
+        "--history-size",
+        type=int,
+        default=50,
+        help="messages fetched per history request",
+    )
+    parser.add_argument(
+        "--reconnect-every",
+        type=int,
+        help="requests a client makes before reconnecting, 0 never does (the default, 100 with --soak)",
+    )
+    parser.add_argument("--output", help="file to write the json to, stdout by default")
+
+    soak_arguments = parser.add_argument_group(
+        "soak test",
+        "run it for long (with --duration) while watching the process for leaks, failing if something grew too much",
+    )
+    soak_arguments.add_argument("--soak", action="store_true")
+    soak_arguments.add_argument(
+        "--sample-interval", type=float, default=10, help="in seconds"
+    )
+    soak_arguments.add_argument(
+        "--warmup",
+        type=float,
+        help="in seconds, growth is counted from after it (a tenth of the duration by default)",
+    )
+    soak_arguments.add_argument(
+        "--rss-budget", type=float, default=64, help="in MiB, of growth"
+    )
+    soak_arguments.add_argument(
+        "--traced-memory-budget",
+        type=float,
+        default=16,
+        help="in MiB, of growth of what tracemalloc sees python allocate",
+    )
+    soak_arguments.add_argument(
+        "--loggers-budget", type=int, default=0, help="of growth"
+    )
+    args = parser.parse_args()
+
+    if args.users < 2:
+        parser.error("at least 2 users are needed")
+    if args.reconnect_every == None:
+        args.reconnect_every = 100 if args.soak else 0
+
+    monitor = None
+    if args.soak:
+        monitor = ResourceMonitor(
+            args.sample_interval,
+            args.warmup if args.warmup != None else args.duration / 10,
+            {
+                "rss_bytes": args.rss_budget * 2**20,
+                "traced_bytes": args.traced_memory_budget * 2**20,
+                "loggers": args.loggers_budget,
+            },
+        )
+
+    logging.basicConfig(level=logging.WARNING)
+    report = LoadTest(
+        args.users,
+        args.clients,
+        args.duration,
+        args.mix,
+        args.message_size,
+        args.history_size,
+        args.reconnect_every,
+        monitor,
+    ).run()
+
+    if args.output == None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if "soak" in report:
+        if len(report["soak"]["failures"]) > 0:
+            print(
+                "Soak test failed:",
+                *report["soak"]["failures"],
+                sep="\n  ",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+        print("Soak test passed", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
-from client import Connection, flask_app, WebGUI
+from client import Connection, flask_app, WebGUI, PooledWSGIServer
+from shared.metrics import start_metrics_server
 from shared.logger import configure_logger
 from shared.config import CLIENT_CONFIG
+from shared.tracing import TRACER
 
 import flask.cli as flask_cli
 import threading
@@ -8,17 +10,34 @@ import logging
 import time
 
 
-configure_logger(logging.DEBUG)
+configure_logger(CLIENT_CONFIG["logging"]["level"])
 
 
 def main() -> None:
     conn = Connection(CLIENT_CONFIG["user"]["token"])
     web_gui = WebGUI(conn)
-    flask_web_gui_runnner = threading.Thread(
-        target=flask_app.run,
-        name="WebGUI",
-        args=[CLIENT_CONFIG["gui"]["host_address"], CLIENT_CONFIG["gui"]["host_port"]],
-    )
+    if CLIENT_CONFIG["gui"]["server"] == "development":
+        flask_web_gui_runnner = threading.Thread(
+            target=flask_app.run,
+            name="WebGUI",
+            args=[
+                CLIENT_CONFIG["gui"]["host_address"],
+                CLIENT_CONFIG["gui"]["host_port"],
+            ],
+        )
+    else:
+        web_gui_server = PooledWSGIServer(
+            CLIENT_CONFIG["gui"]["host_address"],
+            CLIENT_CONFIG["gui"]["host_port"],
+            flask_app,
+            CLIENT_CONFIG["gui"]["worker_threads"],
+            CLIENT_CONFIG["gui"]["max_queued_connections"],
+            CLIENT_CONFIG["gui"]["max_connections"],
+            CLIENT_CONFIG["gui"]["keep_alive_timeout"],
+        )
+        flask_web_gui_runnner = threading.Thread(
+            target=web_gui_server.serve_forever, name="WebGUI"
+        )
 
     # hide flask output
     flask_cli.show_server_banner = lambda *args, **kwargs: None
@@ -31,6 +50,16 @@ def main() -> None:
         CLIENT_CONFIG["connection"]["connect_address"],
         CLIENT_CONFIG["connection"]["connect_port"],
     )
+    if CLIENT_CONFIG["metrics"]["enabled"]:
+        start_metrics_server(
+            CLIENT_CONFIG["metrics"]["listen_address"],
+            CLIENT_CONFIG["metrics"]["listen_port"],
+        )
+    if CLIENT_CONFIG["tracing"]["enabled"]:
+        TRACER.configure(
+            CLIENT_CONFIG["tracing"]["filepath"],
+            CLIENT_CONFIG["tracing"]["sample_rate"],
+        )
     conn.start()
     max_authentication_time = (
         time.time() + CLIENT_CONFIG["connection"]["authentication_timeout"]
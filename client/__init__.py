@@ -1,2 +1,3 @@
 from .webgui.gui import WebGUI as WebGUI, app as flask_app
+from .webgui.server import PooledWSGIServer as PooledWSGIServer
 from .connection import Connection as Connection
@@ -1,24 +1,47 @@
-from shared.packets import ServerPackets, SharedPackets, ClientPackets, Packet
+from shared.packets import (
+    ServerPackets,
+    SharedPackets,
+    ClientPackets,
+    PacketType,
+    Packet,
+)
+from shared.config import CLIENT_CONFIG, SHARED_CONFIG
+from shared.misc import SequentialIdAllocator
+from shared.tracing import TRACER, TraceContext, Span, get_current_trace_context
 from shared.packet_socket import PacketSocket
+from shared.metrics import METRICS_REGISTRY
 from shared.items import Relation, Message
-from shared.config import CLIENT_CONFIG
 
 import dataclasses
+import collections
 import threading
 import logging
+import bisect
 import random
+import select
 import socket
 import time
 import abc
+import os
 
 
-def generate_random_event_id() -> int:
-    return int.from_bytes(random.randbytes(CLIENT_CONFIG["events"]["event_id_bytes"]))
+_event_id_allocator = SequentialIdAllocator(CLIENT_CONFIG["events"]["event_id_bytes"])
+
+
+def generate_event_id() -> int:
+    return _event_id_allocator.next_id()
 
 
 @dataclasses.dataclass(frozen=True)
 class Event(abc.ABC):
     id: int
+    # the trace of whatever made the event, so its request is traced as a part of it
+    trace_context: TraceContext | None = dataclasses.field(
+        default_factory=get_current_trace_context,
+        kw_only=True,
+        compare=False,
+        repr=False,
+    )
 
 
 class InputEvents:
@@ -28,6 +51,8 @@ class InputEvents:
     class GetMessages(Event):
         sender: str
         after: int
+        before: int = 0  # 0 means up to the newest message
+        limit: int = 0  # only the newest this many of the range, 0 means all of them
 
     @dataclasses.dataclass(frozen=True)
     class AddFriend(Event):
@@ -37,10 +62,21 @@ class InputEvents:
     class RemoveFriend(Event):
         username: str
 
+    @dataclasses.dataclass(frozen=True)
+    class UpdateFriends(Event):
+        usernames: list[str]
+        add: bool  # False removes them
+
     @dataclasses.dataclass(frozen=True)
     class SendMessage(Event):
         receiver: str
         content: str
+        # stays the same when the event gets replayed, so the server can drop retries
+        idempotency_key: bytes = dataclasses.field(
+            default_factory=lambda: os.urandom(
+                SHARED_CONFIG["packets"]["idempotency_key_bytes"]
+            )
+        )
 
 
 class OutputEvents:
@@ -58,7 +94,13 @@ class OutputEvents:
 
     class RemoveFriend(Event): ...
 
-    class SendMessage(Event): ...
+    @dataclasses.dataclass(frozen=True)
+    class UpdateFriends(Event):
+        results: list[bool]
+
+    @dataclasses.dataclass(frozen=True)
+    class SendMessage(Event):
+        message_id: int
 
 
 class Connection(threading.Thread):
@@ -66,65 +108,105 @@ class Connection(threading.Thread):
         super().__init__(name="ChatConnection")
         self.__logger = logging.getLogger("Connection")
 
-        self.__sock = socket.socket()
-        self.__sock.connect(
-            (
-                CLIENT_CONFIG["connection"]["connect_address"],
-                CLIENT_CONFIG["connection"]["connect_port"],
-            )
-        )
-        self.__sock.setblocking(False)
-        self.__packet_sock = PacketSocket(self.__sock)
+        self.__sock: socket.socket | None = None
+        self.__packet_sock: PacketSocket = None  # type: ignore
         self.__token = token
 
-        self.__pending_packets = []
         self.__authenticated = False
         self.__username = None
+        self.__resume_ticket: bytes | None = None
 
         self.__running = False
         self.__send_quit = False
+        self.__connected_gauge = METRICS_REGISTRY.gauge(
+            "chat_client_connected", "Whether the client is connected to the server"
+        )
 
-        self.__output_events = []
-        self.__input_events = []
+        # packet id -> (input event, time sent)
+        self.__in_flight_requests: dict[int, tuple[Event, float]] = {}
+        self.__input_events: collections.deque[Event] = collections.deque()
+        # event id -> output event, or None while it is still being waited for. the
+        # oldest are dropped past max_unclaimed_responses, in case nobody picks them up
+        self.__output_events: collections.OrderedDict[int, Event | None] = (
+            collections.OrderedDict()
+        )
+        self.__output_events_condition = threading.Condition()
+        # written to whenever there is something to do that isn't on the socket
+        self.__wakeup_reader, self.__wakeup_writer = socket.socketpair()
+        self.__wakeup_reader.setblocking(False)
+        self.__wakeup_writer.setblocking(False)
+
+        # messages already received from the server (fetched or pushed), per
+        # conversation and sorted by id, so reconnects only fetch what came after
+        # the last seen message
+        self.__message_cache: dict[str, list[Message]] = {}
+        # the id up to which every message of a conversation has been fetched,
+        # pushed messages can skip ahead of it so they don't move it
+        self.__message_cursors: dict[str, int] = {}
+        # the id after which the cache has every message of a conversation, the oldest
+        # are dropped past max_cached_messages and fetched again if they're needed
+        self.__message_cache_starts: dict[str, int] = {}
+        self.__messages_condition = threading.Condition()
+
+        # the server says when relations change, so until then they are answered from here
+        self.__relations: list[Relation] | None = None
+        self.__relations_version = 0
+        # event id -> relations version when the request was sent, a response to
+        # a request sent before the last change is already outdated
+        self.__relations_versions_at_request: dict[int, int] = {}
+        # message id -> id of the event that sent it, until the message is shown. also
+        # capped, a message that was pushed before its id was known is never shown again
+        self.__sent_message_event_ids: collections.OrderedDict[int, int] = (
+            collections.OrderedDict()
+        )
+        # event id -> span from when the event was added to when it was finished,
+        # only for the events that are traced
+        self.__event_spans: dict[int, Span] = {}
 
     def run(self) -> None:
         self.__running = True
 
-        # authenticate
+        # connect and authenticate
+        self.__connect_and_authenticate()
+
+        # main loop
         while self.__running:
             try:
-                auth_packet = ClientPackets.Authenticate()
-                auth_packet.init_packet_from_params(self.__token)
-                response_packet: ServerPackets.Authenticate = self.send_and_wait_for_response(auth_packet)  # type: ignore
-                self.__logger.debug(
-                    "Received authentication response (username: %s, length: %s)",
-                    response_packet.username,
-                    response_packet.data_length,
+                select.select(
+                    [self.__packet_sock.raising_socket, self.__wakeup_reader],
+                    [],
+                    [],
+                    1,
                 )
-                self.__authenticated = response_packet.success
-
-                if not self.__authenticated:
-                    self.__logger.critical(
-                        "Incorrect token supplied (token: %s)",
-                        CLIENT_CONFIG["user"]["token"],
+                self.__clear_wakeups()
+                self.__send_input_events()
+                self.__receive_packets()
+                self.__check_heartbeat()
+            except OSError as error:
+                self.__logger.warning("Lost connection to server (error: %s)", error)
+                self.__connected_gauge.set(0)
+                # in flight requests get replayed once reconnected
+                self.__input_events.extendleft(
+                    reversed(
+                        [
+                            input_event
+                            for input_event, _ in self.__in_flight_requests.values()
+                        ]
                     )
-                    self.stop(send_quit=False)
-                    break
-                self.__username = response_packet.username
-                self.__logger.info(
-                    "Successfully authenticated (username: %s)",
-                    response_packet.username,
                 )
-                break
-            except OSError:
-                self.__running = False
-
-        # main loop
-        while self.__running:
-            time.sleep(0.1)
-            for input_event in self.__input_events:
-                threading.Thread(self.__handle_input_event(input_event)).start()
-                self.__input_events.remove(input_event)
+                self.__in_flight_requests.clear()
+                # changes could have been missed while disconnected
+                self.__invalidate_relations()
+                self.__connect_and_authenticate()
+                # catch up on the messages that were pushed while disconnected
+                for conversation, cursor in list(self.__message_cursors.items()):
+                    self.__input_events.append(
+                        InputEvents.GetMessages(
+                            generate_event_id(), conversation, cursor
+                        )
+                    )
+                continue
+            self.__evict_timed_out_requests()
 
         # quit
         if not self.__send_quit:
@@ -138,47 +220,446 @@ class Connection(threading.Thread):
     def stop(self, send_quit: bool = True) -> None:
         self.__send_quit = send_quit
         self.__running = False
+        self.__wake_up()
 
-    def __handle_input_event(self, input_event: Event) -> None:
+    def __wake_up(self) -> None:
+        try:
+            self.__wakeup_writer.send(b"\x00")
+        except BlockingIOError:
+            pass  # already has pending wakeups
+
+    def __clear_wakeups(self) -> None:
+        try:
+            while True:
+                self.__wakeup_reader.recv(4096)
+        except BlockingIOError:
+            pass
+
+    def __connect(self) -> None:
+        if self.__sock != None:
+            self.__packet_sock.raising_socket.close()
+            self.__sock.close()
+
+        self.__sock = socket.create_connection(
+            (
+                CLIENT_CONFIG["connection"]["connect_address"],
+                CLIENT_CONFIG["connection"]["connect_port"],
+            ),
+            CLIENT_CONFIG["connection"]["authentication_timeout"],
+        )
+        self.__sock.setblocking(False)
+        self.__packet_sock = PacketSocket(self.__sock)
+        self.__last_received_time = time.time()
+        self.__ping_sent_time: float | None = None
+
+    def __authenticate(self) -> None:
+        if self.__resume_ticket != None:
+            # resuming is cheaper for the server than checking the token
+            resume_packet = ClientPackets.ResumeSession()
+            resume_packet.init_packet_from_params(self.__resume_ticket)
+            response_packet: ServerPackets.Authenticate = self.send_and_wait_for_response(resume_packet, CLIENT_CONFIG["connection"]["authentication_timeout"])  # type: ignore
+            if response_packet.success:
+                self.__resume_ticket = response_packet.resume_ticket
+                self.__logger.info(
+                    "Successfully resumed session (username: %s)",
+                    response_packet.username,
+                )
+                return
+            self.__logger.info("Resume ticket rejected, authenticating with token")
+            self.__resume_ticket = None
+
+        auth_packet = ClientPackets.Authenticate()
+        auth_packet.init_packet_from_params(self.__token)
+        response_packet: ServerPackets.Authenticate = self.send_and_wait_for_response(auth_packet, CLIENT_CONFIG["connection"]["authentication_timeout"])  # type: ignore
+        self.__logger.debug(
+            "Received authentication response (username: %s, length: %s)",
+            response_packet.username,
+            response_packet.data_length,
+        )
+        self.__authenticated = response_packet.success
+
+        if not self.__authenticated:
+            self.__logger.critical(
+                "Incorrect token supplied (token: %s)",
+                CLIENT_CONFIG["user"]["token"],
+            )
+            self.stop(send_quit=False)
+            return
+        self.__username = response_packet.username
+        self.__resume_ticket = response_packet.resume_ticket
+        self.__logger.info(
+            "Successfully authenticated (username: %s)",
+            response_packet.username,
+        )
+
+    def __connect_and_authenticate(self) -> None:
+        attempt = 0
+        while self.__running:
+            if attempt > 0:
+                # exponential backoff with full jitter, so a restarting server
+                # doesn't get every client reconnecting at the same moment
+                delay = random.uniform(
+                    0,
+                    min(
+                        CLIENT_CONFIG["connection"]["reconnect_max_delay"],
+                        CLIENT_CONFIG["connection"]["reconnect_initial_delay"]
+                        * 2 ** (attempt - 1),
+                    ),
+                )
+                self.__logger.info(
+                    "Reconnecting (attempt: %s, delay: %.2f seconds)", attempt, delay
+                )
+                time.sleep(delay)
+            attempt += 1
+
+            try:
+                self.__connect()
+                self.__authenticate()
+                self.__connected_gauge.set(1 if self.__authenticated else 0)
+                return
+            except OSError as error:
+                self.__logger.warning("Failed to connect (error: %s)", error)
+
+    def __send_input_events(self) -> None:
+        while self.__running and len(self.__input_events) > 0:
+            input_event = self.__input_events.popleft()
+            if isinstance(input_event, InputEvents.GetRelations):
+                relations = self.__relations
+                if relations != None:
+                    self.__finish_input_event(
+                        input_event.id,
+                        OutputEvents.GetRelations(input_event.id, relations),
+                    )
+                    continue
+                self.__relations_versions_at_request[input_event.id] = (
+                    self.__relations_version
+                )
+            elif (
+                isinstance(input_event, InputEvents.GetMessages)
+                and input_event.before != 0
+                and self.__has_cached_messages(input_event)
+            ):
+                # the cache has the conversation up to the cursor, so older messages
+                # only need another request if they were dropped from it
+                with self.__messages_condition:
+                    self.__finish_input_event(
+                        input_event.id,
+                        OutputEvents.GetMessages(
+                            input_event.id,
+                            self.__get_cached_messages(
+                                input_event.sender,
+                                input_event.after,
+                                input_event.before,
+                                input_event.limit,
+                            ),
+                        ),
+                    )
+                continue
+
+            request_packet = self.__create_request_packet(input_event)
+            event_span = self.__event_spans.get(input_event.id)
+            if event_span != None:
+                # the server's spans go under it
+                request_packet.trace_context = event_span.context
+            try:
+                self.__packet_sock.send(request_packet)
+            except OSError:
+                self.__input_events.appendleft(input_event)
+                raise
+            self.__in_flight_requests[request_packet.id] = (input_event, time.time())
+
+    def __receive_packets(self) -> None:
+        while self.__running:
+            try:
+                packet = self.__packet_sock.recv()
+            except BlockingIOError:
+                return
+
+            # anything coming from the server means it is still there
+            self.__last_received_time = time.time()
+            self.__ping_sent_time = None
+
+            if packet.type == PacketType.quit:
+                raise ConnectionResetError("Server quit")
+            if packet.type == PacketType.pong:
+                continue
+            if packet.type == PacketType.server_new_message:
+                # pushes aren't responses, their ids come from the server
+                for message in packet.messages:  # type: ignore
+                    self.__merge_messages(
+                        (
+                            message.receiver
+                            if message.sender == self.__username
+                            else message.sender
+                        ),
+                        [message],
+                    )
+                    self.__drop_old_messages(
+                        message.receiver
+                        if message.sender == self.__username
+                        else message.sender
+                    )
+                continue
+            if packet.type == PacketType.server_relations_changed:
+                self.__invalidate_relations()
+                continue
+
+            in_flight_request = self.__in_flight_requests.pop(packet.id, None)
+            if in_flight_request == None:
+                self.__logger.debug(
+                    "Dropping response to unknown request (type: %s, id: %s)",
+                    packet.type.name,
+                    packet.id,
+                )
+                continue
+
+            input_event, time_sent = in_flight_request
+            METRICS_REGISTRY.histogram(
+                "chat_client_request_seconds",
+                "Time from sending a request to the server to getting its response",
+                event=type(input_event).__name__,
+            ).observe(time.time() - time_sent)
+            if packet.type == PacketType.invalid_packet_type:
+                self.__logger.error(
+                    "Server rejected request (event: %s, id: %s)",
+                    type(input_event).__name__,
+                    input_event.id,
+                )
+                self.__finish_input_event(input_event.id, None)
+                continue
+
+            self.__finish_input_event(
+                input_event.id, self.__create_output_event(input_event, packet)
+            )
+
+    def __check_heartbeat(self) -> None:
+        if self.__ping_sent_time != None:
+            if (
+                time.time() - self.__ping_sent_time
+                > CLIENT_CONFIG["connection"]["heartbeat_timeout"]
+            ):
+                raise TimeoutError("Server didn't answer heartbeat")
+            return
+
+        if (
+            time.time() - self.__last_received_time
+            > CLIENT_CONFIG["connection"]["heartbeat_interval"]
+        ):
+            self.__packet_sock.send(SharedPackets.Ping())
+            self.__ping_sent_time = time.time()
+
+    def __evict_timed_out_requests(self) -> None:
+        min_time_sent = time.time() - CLIENT_CONFIG["events"]["request_timeout"]
+
+        # requests are in the order they were sent, so only the oldest ones are checked
+        while len(self.__in_flight_requests) > 0:
+            packet_id = next(iter(self.__in_flight_requests))
+            input_event, time_sent = self.__in_flight_requests[packet_id]
+            if time_sent > min_time_sent:
+                break
+
+            del self.__in_flight_requests[packet_id]
+            self.__logger.warning(
+                "Request timed out (event: %s, id: %s)",
+                type(input_event).__name__,
+                input_event.id,
+            )
+            self.__finish_input_event(input_event.id, None)
+
+    def __finish_input_event(self, event_id: int, output_event: Event | None) -> None:
+        self.__relations_versions_at_request.pop(event_id, None)
+        event_span = self.__event_spans.pop(event_id, None)
+        if event_span != None:
+            event_span.end()
+
+        with self.__output_events_condition:
+            if event_id not in self.__output_events:
+                return  # nobody is waiting for it
+
+            if output_event == None:
+                del self.__output_events[event_id]
+            else:
+                self.__output_events[event_id] = output_event
+            self.__output_events_condition.notify_all()
+
+    def __create_request_packet(self, input_event: Event) -> Packet:
         match type(input_event):
             case InputEvents.GetRelations:
-                response = self.send_and_wait_for_response(ClientPackets.GetRelations())
-                self.__output_events.append(OutputEvents.GetRelations(input_event.id, response.relations))  # type: ignore
+                return ClientPackets.GetRelations()
             case InputEvents.GetMessages:
                 get_messages_packet = ClientPackets.GetMessages()
-                get_messages_packet.init_packet_from_params(input_event.sender, input_event.after)  # type: ignore
-                response = self.send_and_wait_for_response(get_messages_packet)
-                self.__output_events.append(OutputEvents.GetMessages(input_event.id, response.messages))  # type: ignore
+                get_messages_packet.init_packet_from_params(
+                    input_event.sender,  # type: ignore
+                    (
+                        self.__message_cursors[input_event.sender]  # type: ignore
+                        if self.__has_cached_messages(input_event)  # type: ignore
+                        # the server only has "everything after", so from where it starts
+                        else min(input_event.after, self.__message_cursors.get(input_event.sender, 0))  # type: ignore
+                    ),
+                )
+                return get_messages_packet
             case InputEvents.AddFriend:
                 add_friend_packet = ClientPackets.AddFriend()
                 add_friend_packet.init_packet_from_params(input_event.username)  # type: ignore
-                response = self.send_and_wait_for_response(add_friend_packet)
-                self.__output_events.append(OutputEvents.AddFriend(input_event.id, response.success))  # type: ignore
+                return add_friend_packet
             case InputEvents.RemoveFriend:
                 remove_friend_packet = ClientPackets.RemoveFriend()
                 remove_friend_packet.init_packet_from_params(input_event.username)  # type: ignore
-                self.send_and_wait_for_response(remove_friend_packet)
-                self.__output_events.append(OutputEvents.RemoveFriend(input_event.id))
+                return remove_friend_packet
+            case InputEvents.UpdateFriends:
+                update_friends_packet = ClientPackets.UpdateFriends()
+                update_friends_packet.init_packet_from_params(input_event.usernames, input_event.add)  # type: ignore
+                return update_friends_packet
             case InputEvents.SendMessage:
                 send_message_packet = ClientPackets.SendMessage()
-                send_message_packet.init_packet_from_params(input_event.receiver, input_event.content)  # type: ignore
-                self.send_and_wait_for_response(send_message_packet)
-                self.__output_events.append(OutputEvents.SendMessage(input_event.id))
+                send_message_packet.init_packet_from_params(input_event.receiver, input_event.content, input_event.idempotency_key)  # type: ignore
+                return send_message_packet
+            case _:
+                raise TypeError(f"unknown input event '{type(input_event).__name__}'")
 
-    def send_and_wait_for_response(self, send_packet: Packet) -> Packet:
+    def __create_output_event(self, input_event: Event, response: Packet) -> Event:
+        match type(input_event):
+            case InputEvents.GetRelations:
+                if (
+                    self.__relations_versions_at_request.get(input_event.id)
+                    == self.__relations_version
+                ):
+                    self.__relations = response.relations  # type: ignore
+                return OutputEvents.GetRelations(input_event.id, response.relations)  # type: ignore
+            case InputEvents.GetMessages:
+                self.__merge_messages(input_event.sender, response.messages)  # type: ignore
+                with self.__messages_condition:
+                    # the response has everything after the cursor it was requested
+                    # with, which is at most the current one
+                    if len(response.messages) > 0:  # type: ignore
+                        self.__message_cursors[input_event.sender] = max(self.__message_cursors.get(input_event.sender, 0), response.messages[-1].id)  # type: ignore
+                    else:
+                        self.__message_cursors.setdefault(input_event.sender, 0)  # type: ignore
+                    output_event = OutputEvents.GetMessages(input_event.id, self.__get_cached_messages(input_event.sender, input_event.after, input_event.before, input_event.limit))  # type: ignore
+                    # only now, the messages that were fetched again are in the output
+                    self.__drop_old_messages(input_event.sender)  # type: ignore
+                    return output_event
+            # the server pushes that relations changed after it answers, so whoever got
+            # the answer could otherwise still be given the old ones
+            case InputEvents.AddFriend:
+                self.__invalidate_relations()
+                return OutputEvents.AddFriend(input_event.id, response.success)  # type: ignore
+            case InputEvents.RemoveFriend:
+                self.__invalidate_relations()
+                return OutputEvents.RemoveFriend(input_event.id)
+            case InputEvents.UpdateFriends:
+                self.__invalidate_relations()
+                return OutputEvents.UpdateFriends(input_event.id, response.results)  # type: ignore
+            case InputEvents.SendMessage:
+                self.__sent_message_event_ids[response.message_id] = input_event.id  # type: ignore
+                while (
+                    len(self.__sent_message_event_ids)
+                    > CLIENT_CONFIG["events"]["max_unclaimed_responses"]
+                ):
+                    self.__sent_message_event_ids.popitem(last=False)
+                return OutputEvents.SendMessage(input_event.id, response.message_id)  # type: ignore
+            case _:
+                raise TypeError(f"unknown input event '{type(input_event).__name__}'")
+
+    def __invalidate_relations(self) -> None:
+        self.__relations = None
+        self.__relations_version += 1
+
+    def __merge_messages(self, conversation: str, messages: list[Message]) -> None:
+        with self.__messages_condition:
+            cached_messages = self.__message_cache.setdefault(conversation, [])
+            for message in messages:
+                if len(cached_messages) == 0 or message.id > cached_messages[-1].id:
+                    cached_messages.append(message)
+                    continue
+
+                # older than the newest cached message, a fetch filling a gap
+                index = bisect.bisect_left(
+                    cached_messages, message.id, key=lambda message: message.id
+                )
+                if cached_messages[index].id != message.id:
+                    cached_messages.insert(index, message)
+            self.__messages_condition.notify_all()
+
+    def __drop_old_messages(self, conversation: str) -> None:
+        with self.__messages_condition:
+            cached_messages = self.__message_cache.get(conversation, [])
+            excess = (
+                len(cached_messages) - CLIENT_CONFIG["events"]["max_cached_messages"]
+            )
+            if excess <= 0:
+                return
+            self.__message_cache_starts[conversation] = cached_messages[excess - 1].id
+            del cached_messages[:excess]
+
+    def __has_cached_messages(self, input_event: InputEvents.GetMessages) -> bool:
+        # whether the cache has everything a GetMessages asks for, without what came
+        # after the cursor
+        with self.__messages_condition:
+            if input_event.sender not in self.__message_cursors:
+                return False
+            if input_event.after >= self.__message_cache_starts.get(
+                input_event.sender, 0
+            ):
+                return True
+            # only the newest ones before `before` are asked for, they could all be there
+            return (
+                input_event.limit != 0
+                and len(
+                    self.__get_cached_messages(
+                        input_event.sender,
+                        input_event.after,
+                        input_event.before,
+                        input_event.limit,
+                    )
+                )
+                == input_event.limit
+            )
+
+    def __get_cached_messages(
+        self, conversation: str, after: int, before: int = 0, limit: int = 0
+    ) -> list[Message]:
+        cached_messages = self.__message_cache.get(conversation, [])
+        start = bisect.bisect_right(
+            cached_messages, after, key=lambda message: message.id
+        )
+        end = (
+            bisect.bisect_left(cached_messages, before, key=lambda message: message.id)
+            if before != 0
+            else len(cached_messages)
+        )
+        if limit != 0:
+            start = max(start, end - limit)
+
+        return cached_messages[start:end]
+
+    def send_and_wait_for_response(
+        self, send_packet: Packet, timeout: float | None = None
+    ) -> Packet:
         self.__packet_sock.send(send_packet)
 
+        max_wait_time = None if timeout == None else time.time() + timeout
         while True:
-            for received_packet in self.__pending_packets:
-                if received_packet.id == send_packet.id:
-                    self.__pending_packets.remove(received_packet)
-                    return received_packet
+            remaining_time = (
+                None if max_wait_time == None else max_wait_time - time.time()
+            )
+            if remaining_time != None and remaining_time <= 0:
+                raise TimeoutError("Timed out waiting for response")
+
+            select.select([self.__packet_sock.raising_socket], [], [], remaining_time)
             try:
-                self.__pending_packets.append(self.__packet_sock.recv())
+                received_packet = self.__packet_sock.recv()
             except BlockingIOError:
-                time.sleep(0.1)
                 continue
 
+            if received_packet.id == send_packet.id:
+                return received_packet
+            self.__logger.debug(
+                "Dropping unexpected packet (type: %s, id: %s)",
+                received_packet.type.name,
+                received_packet.id,
+            )
+
     @property
     def authenticated(self) -> bool:
         return self.__authenticated
@@ -187,15 +668,134 @@ class Connection(threading.Thread):
     def username(self) -> str | None:
         return self.__username
 
+    @property
+    def relations_version(self) -> int:
+        return self.__relations_version
+
+    def get_conversation_version(self, secondary_username: str) -> int | None:
+        # the id of the newest message, None if the conversation was never fetched
+        with self.__messages_condition:
+            if secondary_username not in self.__message_cursors:
+                return None
+            cached_messages = self.__message_cache.get(secondary_username, [])
+            return cached_messages[-1].id if len(cached_messages) > 0 else 0
+
     def add_input_event(self, event: Event) -> None:
+        if event.trace_context != None:
+            event_span = TRACER.start_span(
+                f"event {type(event).__name__}", event.trace_context, event_id=event.id
+            )
+            if event_span != None:
+                self.__event_spans[event.id] = event_span
         self.__input_events.append(event)
-
-    def add_input_event_and_wait_for_response(self, input_event: Event) -> Event:
+        self.__wake_up()
+
+    def add_input_event_and_wait_for_response(
+        self, input_event: Event, timeout: float | None = None
+    ) -> Event:
+        self.add_input_event_for_response(input_event)
+        return self.wait_for_response(input_event.id, timeout)
+
+    def add_input_event_for_response(self, input_event: Event) -> None:
+        # the response is kept until wait_for_response picks it up
+        with self.__output_events_condition:
+            self.__add_output_event_slot(input_event.id)
         self.add_input_event(input_event)
 
-        while True:
-            for output_event in self.__output_events:
-                if output_event.id == input_event.id:
-                    self.__output_events.remove(output_event)
+    def __add_output_event_slot(self, event_id: int) -> None:
+        # with the condition held
+        self.__output_events[event_id] = None
+        if (
+            len(self.__output_events)
+            <= CLIENT_CONFIG["events"]["max_unclaimed_responses"]
+        ):
+            return
+        while (
+            len(self.__output_events)
+            > CLIENT_CONFIG["events"]["max_unclaimed_responses"]
+        ):
+            self.__output_events.popitem(last=False)
+        # whoever was waiting for a dropped one fails right away
+        self.__output_events_condition.notify_all()
+
+    def wait_for_response(self, event_id: int, timeout: float | None = None) -> Event:
+        max_wait_time = time.time() + (
+            CLIENT_CONFIG["events"]["request_timeout"] if timeout == None else timeout
+        )
+
+        with self.__output_events_condition:
+            while True:
+                if event_id not in self.__output_events:
+                    raise ConnectionError(f"request failed (event id: {event_id})")
+
+                output_event = self.__output_events[event_id]
+                if output_event != None:
+                    del self.__output_events[event_id]
                     return output_event
-            time.sleep(0.1)
+
+                remaining_time = max_wait_time - time.time()
+                if remaining_time <= 0:
+                    del self.__output_events[event_id]
+                    raise TimeoutError(f"request timed out (event id: {event_id})")
+                self.__output_events_condition.wait(remaining_time)
+
+    def add_input_events_and_wait_for_responses(
+        self, input_events: list[Event], timeout: float | None = None
+    ) -> list[Event | None]:
+        # all of the requests are in flight together, so this takes as long as the
+        # slowest one instead of all of them added up. the ones that failed or
+        # didn't make it before the timeout are None
+        max_wait_time = time.time() + (
+            CLIENT_CONFIG["events"]["request_timeout"] if timeout == None else timeout
+        )
+
+        with self.__output_events_condition:
+            for input_event in input_events:
+                self.__add_output_event_slot(input_event.id)
+        for input_event in input_events:
+            self.add_input_event(input_event)
+
+        output_events: dict[int, Event | None] = {}
+        with self.__output_events_condition:
+            while True:
+                for input_event in input_events:
+                    if input_event.id in output_events:
+                        continue
+
+                    if input_event.id not in self.__output_events:
+                        output_events[input_event.id] = None
+                    elif self.__output_events[input_event.id] != None:
+                        output_events[input_event.id] = self.__output_events.pop(
+                            input_event.id
+                        )
+
+                remaining_time = max_wait_time - time.time()
+                if len(output_events) == len(input_events) or remaining_time <= 0:
+                    break
+                self.__output_events_condition.wait(remaining_time)
+
+            for input_event in input_events:
+                if input_event.id not in output_events:
+                    self.__output_events.pop(input_event.id, None)
+                    self.__logger.warning(
+                        "Gave up waiting for a response (event: %s, id: %s)",
+                        type(input_event).__name__,
+                        input_event.id,
+                    )
+
+        return [output_events.get(input_event.id) for input_event in input_events]
+
+    def pop_sending_event_id(self, message_id: int) -> int | None:
+        # the server answers a send before pushing the message, so this is known by
+        # the time the message is
+        return self.__sent_message_event_ids.pop(message_id, None)
+
+    def wait_for_new_messages(
+        self, secondary_username: str, after: int, timeout: float
+    ) -> list[Message]:
+        with self.__messages_condition:
+            self.__messages_condition.wait_for(
+                lambda: len(self.__get_cached_messages(secondary_username, after)) > 0,
+                timeout,
+            )
+            return self.__get_cached_messages(secondary_username, after)
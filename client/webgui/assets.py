@@ -0,0 +1,59 @@
+import hashlib
+import logging
+import os
+import re
+
+
+# the gui has to work without internet, and everything local is in the bundle anyway,
+# so stylesheets can't import anything
+CSS_IMPORT_PATTERN = re.compile(r"^@import .*;[ \t]*\n?", re.MULTILINE)
+
+
+class StaticAssets:
+    def __init__(self, static_folder: str) -> None:
+        # the names have the hash of the content in them, so they never change and
+        # browsers can keep them forever
+        self.__assets: dict[str, tuple[bytes, str]] = {}
+        self.__hashed_names: dict[str, str] = {}
+
+        self.__add_asset(
+            "bundle.css",
+            self.__bundle_css(os.path.join(static_folder, "css")),
+            "text/css",
+        )
+        # htmx 1.9.11, so the gui works without internet
+        with open(os.path.join(static_folder, "vendor", "htmx.js"), "rb") as file:
+            self.__add_asset("htmx.js", file.read(), "text/javascript")
+
+    def get_url(self, name: str) -> str:
+        return f"/assets/{self.__hashed_names[name]}"
+
+    def get_asset(self, hashed_name: str) -> tuple[bytes, str] | None:
+        return self.__assets.get(hashed_name)
+
+    def __add_asset(self, name: str, content: bytes, mimetype: str) -> None:
+        stem, extension = os.path.splitext(name)
+        hashed_name = f"{stem}-{hashlib.sha256(content).hexdigest()[:16]}{extension}"
+
+        self.__assets[hashed_name] = (content, mimetype)
+        self.__hashed_names[name] = hashed_name
+
+    def __bundle_css(self, css_folder: str) -> bytes:
+        stylesheets: list[str] = []
+        for file_name in sorted(os.listdir(css_folder)):
+            if not file_name.endswith(".css"):
+                continue
+
+            with open(os.path.join(css_folder, file_name), encoding="utf-8") as file:
+                stylesheet = file.read()
+            for css_import in CSS_IMPORT_PATTERN.findall(stylesheet):
+                logging.getLogger("StaticAssets").warning(
+                    "Leaving %s out of the css bundle (file: %s)",
+                    css_import.strip(),
+                    file_name,
+                )
+            stylesheets.append(
+                f"/* {file_name} */\n" + CSS_IMPORT_PATTERN.sub("", stylesheet)
+            )
+
+        return "\n\n".join(stylesheets).encode()
@@ -1,8 +1,30 @@
-from client.connection import InputEvents, Connection, generate_random_event_id
+from client.connection import InputEvents, Connection, generate_event_id
+from shared.config import CLIENT_CONFIG
+from shared.items import Relation, Message
+from shared.tracing import TRACER
+from .rendered_messages import RenderedMessages, prettify_time
+from .assets import StaticAssets
 
 import flask_htmx
-import datetime
+import markupsafe
 import flask
+import time
+import os
+
+
+class _TracingMiddleware:
+    # browser requests start traces, the events they add (and so the server's work
+    # for them) are a part of it
+    def __init__(self, wsgi_app) -> None:
+        self.__wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "/")
+        # the route without its arguments, like "GET /chat_page"
+        with TRACER.span(
+            f"{environ['REQUEST_METHOD']} /{path.split('/')[1]}", root=True, path=path
+        ):
+            return self.__wsgi_app(environ, start_response)
 
 
 app = flask.Flask(
@@ -11,29 +33,135 @@ app = flask.Flask(
     static_folder="client/webgui/static",
 )
 htmx = flask_htmx.HTMX(app)
+app.wsgi_app = _TracingMiddleware(app.wsgi_app)  # type: ignore
+# "sse" or "poll", how the chat view gets new messages
+app.jinja_env.globals["live_updates"] = CLIENT_CONFIG["gui"]["live_updates"]
+static_assets = StaticAssets(app.static_folder)  # type: ignore
+app.jinja_env.globals["asset_url"] = static_assets.get_url
+rendered_messages = RenderedMessages(
+    app.jinja_env.get_template("chat_message.jinja2"),
+    CLIENT_CONFIG["gui"]["rendered_messages_cache_size"],
+)
+
+# the versions in etags start over with every run, so they get a random prefix
+_etag_prefix = os.urandom(4).hex()
+
+
+def _make_etag(*versions: int) -> str:
+    return "-".join([_etag_prefix, *[str(version) for version in versions]])
 
 
-def _get_pretty_messages(
-    connection: Connection, secondary_username: str
-) -> list[dict[str, str]]:
-    raw_messages = connection.add_input_event_and_wait_for_response(
+def _make_cacheable_response(body: str, etag: str | None) -> flask.Response:
+    response = flask.make_response(body)
+    if etag != None:
+        response.set_etag(etag)
+        # the browser has to ask every time, but doesn't have to download it again
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def _get_raw_messages(
+    connection: Connection,
+    secondary_username: str,
+    after: int = 0,
+    before: int = 0,
+    limit: int = 0,
+) -> list[Message]:
+    return connection.add_input_event_and_wait_for_response(
         InputEvents.GetMessages(
-            generate_random_event_id(),
+            generate_event_id(),
             secondary_username,
-            0,  # after=0 means fetch all messages
+            after,  # after=0 means fetch all messages
+            before,
+            limit,
         )
     ).messages  # type: ignore
 
-    return [
-        {
-            "sender": message.sender,
-            "content": message.content,
-            "time_sent": datetime.datetime.fromtimestamp(message.time_sent).strftime(
-                "%Y-%m-%d %H:%M:%S"
-            ),
-        }
-        for message in raw_messages
+
+def _get_window_messages(
+    connection: Connection, secondary_username: str, first: int, last: int
+) -> list[Message]:
+    # the messages the browser currently has, from the first to the last one it was sent
+    if first == 0:
+        return []
+
+    return _get_raw_messages(connection, secondary_username, first - 1, last + 1)
+
+
+def _parse_event_id(event_id: str) -> tuple[int, int] | None:
+    # "first:last", the first and last message the browser has after the event
+    first, separator, last = event_id.partition(":")
+    if separator == "" or not first.isdigit() or not last.isdigit():
+        return None
+    return int(first), int(last)
+
+
+def _make_chat_context(messages: list[Message] | None) -> dict:
+    # the newest page of the conversation, older ones are loaded when scrolled up to
+    return {
+        "messages": _prettify_messages(messages) if messages != None else None,
+        "has_older": messages != None
+        and len(messages) == CLIENT_CONFIG["gui"]["messages_page_size"],
+        "is_latest": True,
+        "first_message_id": messages[0].id if messages else 0,
+        "last_message_id": messages[-1].id if messages else 0,
+    }
+
+
+def _render_appended_messages(
+    connection: Connection,
+    secondary_username: str,
+    first: int,
+    last: int,
+    new_messages: list[Message],
+) -> tuple[str, int, int]:
+    # the browser keeps at most max_rendered_messages, the oldest ones make room for new ones
+    window_messages = _get_window_messages(connection, secondary_username, first, last)
+    kept_messages = (window_messages + new_messages)[
+        -CLIENT_CONFIG["gui"]["max_rendered_messages"] :
     ]
+    if len(kept_messages) == 0:
+        return "", first, last
+    first, last = kept_messages[0].id, kept_messages[-1].id
+
+    shown_messages = [message for message in new_messages if message.id >= first]
+    rendered = flask.render_template(
+        "chat_messages.jinja2", messages=_prettify_messages(shown_messages)
+    ) + flask.render_template(
+        "chat_messages_deleted.jinja2",
+        deleted_message_ids=[
+            message.id for message in window_messages if message.id < first
+        ],
+        # the real ones replace the ones shown while sending
+        deleted_pending_ids=[
+            event_id
+            for event_id in [
+                connection.pop_sending_event_id(message.id)
+                for message in shown_messages
+                if message.sender == connection.username
+            ]
+            if event_id != None
+        ],
+    )
+    if len(kept_messages) < len(window_messages) + len(new_messages):
+        rendered += flask.render_template(
+            "chat_top_edge.jinja2",
+            secondary_username=secondary_username,
+            has_older=True,
+            out_of_band=True,
+        )
+    rendered += flask.render_template(
+        "chat_window.jinja2",
+        first_message_id=first,
+        last_message_id=last,
+        out_of_band=True,
+    )
+
+    return rendered, first, last
+
+
+def _prettify_messages(raw_messages: list[Message]) -> list[markupsafe.Markup]:
+    return rendered_messages.render(raw_messages)
 
 
 @app.route("/empty", methods=["GET"])
@@ -46,6 +174,18 @@ def index():
     return flask.redirect("/friends")
 
 
+@app.route("/assets/<hashed_name>", methods=["GET"])
+def assets(hashed_name: str):
+    asset = static_assets.get_asset(hashed_name)
+    if asset == None:
+        flask.abort(404)
+
+    response = flask.Response(asset[0], mimetype=asset[1])
+    # the content of a name never changes, so browsers don't even have to ask again
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
 class WebGUI:
     def __init__(self, connection: Connection) -> None:
         self.__connection = connection
@@ -59,73 +199,383 @@ class WebGUI:
         app.route("/chat_messages/<secondary_username>", methods=["GET"])(
             self.chat_messages
         )
+        app.route("/chat_events/<secondary_username>", methods=["GET"])(
+            self.chat_events
+        )
+        app.route("/chat_history/<secondary_username>", methods=["GET"])(
+            self.chat_history
+        )
         app.route("/send_message", methods=["POST"])(self.send_message)
+        app.route("/send_message_status/<int:event_id>", methods=["GET"])(
+            self.send_message_status
+        )
 
         app.route("/remove_friend", methods=["POST"])(self.remove_friend)
         app.route("/add_friend", methods=["POST"])(self.add_friend)
+        app.route("/update_friends", methods=["POST"])(self.update_friends)
 
     def friends(self):
-        return flask.render_template(
-            "friends.jinja2",
-            relations=(
-                self.__connection.add_input_event_and_wait_for_response(
-                    InputEvents.GetRelations(generate_random_event_id())
-                ).relations  # type: ignore
+        etag = _make_etag(self.__connection.relations_version)
+        if flask.request.if_none_match.contains(etag):
+            return flask.Response(status=304)
+
+        return _make_cacheable_response(
+            flask.render_template(
+                "friends.jinja2",
+                relations=(
+                    self.__connection.add_input_event_and_wait_for_response(
+                        InputEvents.GetRelations(generate_event_id())
+                    ).relations  # type: ignore
+                ),
             ),
+            etag,
         )
 
     def chat_page(self, secondary_username: str):
-        return flask.render_template(
-            "chat_page.jinja2",
-            secondary_username=secondary_username,
-            relations=self.__connection.add_input_event_and_wait_for_response(
-                InputEvents.GetRelations(generate_random_event_id())
-            ).relations,  # type: ignore
-            messages=_get_pretty_messages(self.__connection, secondary_username),
+        # the versions are taken before fetching, so the page can only be newer than its etag
+        conversation_version = self.__connection.get_conversation_version(
+            secondary_username
+        )
+        etag = (
+            _make_etag(self.__connection.relations_version, conversation_version)
+            if conversation_version != None
+            else None  # never fetched, so there is nothing to compare with
+        )
+        if etag != None and flask.request.if_none_match.contains(etag):
+            return flask.Response(status=304)
+
+        relations_response, messages_response = (
+            self.__connection.add_input_events_and_wait_for_responses(
+                [
+                    InputEvents.GetRelations(generate_event_id()),
+                    InputEvents.GetMessages(
+                        generate_event_id(),
+                        secondary_username,
+                        0,
+                        limit=CLIENT_CONFIG["gui"]["messages_page_size"],
+                    ),
+                ],
+                CLIENT_CONFIG["gui"]["page_deadline"],
+            )
+        )
+        # the parts that didn't make it are rendered as unavailable (None)
+        relations = (
+            relations_response.relations if relations_response != None else None  # type: ignore
+        )
+        messages = (
+            messages_response.messages if messages_response != None else None  # type: ignore
+        )
+        if relations == None or messages == None:
+            etag = None  # a partial page mustn't be reused
+
+        return _make_cacheable_response(
+            flask.render_template(
+                "chat_page.jinja2",
+                secondary_username=secondary_username,
+                relations=relations,
+                # without messages, the live updates start from the beginning and fill them in
+                **_make_chat_context(messages),
+            ),
+            etag,
         )
 
     def chat_messages(self, secondary_username: str):
-        return flask.render_template(
-            "chat_messages.jinja2",
-            messages=_get_pretty_messages(self.__connection, secondary_username),
+        # the browser sends the first and last message it has
+        first = flask.request.args.get("first", 0, type=int)
+        after = flask.request.args.get("last", 0, type=int)
+
+        # new messages get pushed to the connection, so if it has none there are none
+        conversation_version = self.__connection.get_conversation_version(
+            secondary_username
+        )
+        if conversation_version != None and conversation_version <= after:
+            return flask.Response(status=204)
+        etag = (
+            _make_etag(conversation_version) if conversation_version != None else None
+        )
+        if etag != None and flask.request.if_none_match.contains(etag):
+            return flask.Response(status=304)
+
+        # only the messages after the ones the browser already has
+        messages = _get_raw_messages(self.__connection, secondary_username, after)
+        if len(messages) == 0:
+            return flask.Response(status=204)
+
+        return _make_cacheable_response(
+            _render_appended_messages(
+                self.__connection, secondary_username, first, after, messages
+            )[0],
+            etag,
+        )
+
+    def chat_history(self, secondary_username: str):
+        first = flask.request.args.get("first", 0, type=int)
+        last = flask.request.args.get("last", 0, type=int)
+        page_size = CLIENT_CONFIG["gui"]["messages_page_size"]
+
+        if flask.request.args.get("direction") == "newer":
+            # back down towards the newest messages, which were dropped to make room
+            newer_messages = _get_raw_messages(
+                self.__connection, secondary_username, last
+            )
+            rendered, first, last = _render_appended_messages(
+                self.__connection,
+                secondary_username,
+                first,
+                last,
+                newer_messages[:page_size],
+            )
+            return rendered + flask.render_template(
+                "chat_bottom_edge.jinja2",
+                secondary_username=secondary_username,
+                is_latest=len(newer_messages) <= page_size,
+                first_message_id=first,
+                last_message_id=last,
+            )
+
+        older_messages = (
+            _get_raw_messages(
+                self.__connection, secondary_username, 0, first, page_size
+            )
+            if first != 0
+            else []
+        )
+        window_messages = _get_window_messages(
+            self.__connection, secondary_username, first, last
+        )
+        # the newest ones make room for the older ones, and the live updates stop until
+        # they are back
+        kept_messages = (older_messages + window_messages)[
+            : CLIENT_CONFIG["gui"]["max_rendered_messages"]
+        ]
+        if len(kept_messages) == 0:
+            return flask.render_template(
+                "chat_top_edge.jinja2",
+                secondary_username=secondary_username,
+                has_older=False,
+            )
+        first, last = kept_messages[0].id, kept_messages[-1].id
+
+        return (
+            flask.render_template(
+                "chat_top_edge.jinja2",
+                secondary_username=secondary_username,
+                has_older=len(older_messages) == page_size,
+            )
+            + flask.render_template(
+                "chat_messages.jinja2",
+                messages=_prettify_messages(older_messages),
+            )
+            + flask.render_template(
+                "chat_messages_deleted.jinja2",
+                deleted_message_ids=[
+                    message.id for message in window_messages if message.id > last
+                ],
+            )
+            + flask.render_template(
+                "chat_bottom_edge.jinja2",
+                secondary_username=secondary_username,
+                is_latest=last
+                >= (
+                    self.__connection.get_conversation_version(secondary_username) or 0
+                ),
+                first_message_id=first,
+                last_message_id=last,
+                out_of_band=True,
+            )
+            + flask.render_template(
+                "chat_window.jinja2",
+                first_message_id=first,
+                last_message_id=last,
+                out_of_band=True,
+            )
         )
 
     def chat(self, secondary_username: str):
         return flask.render_template(
             "chat.jinja2",
             secondary_username=secondary_username,
-            messages=_get_pretty_messages(self.__connection, secondary_username),
+            **_make_chat_context(
+                _get_raw_messages(
+                    self.__connection,
+                    secondary_username,
+                    limit=CLIENT_CONFIG["gui"]["messages_page_size"],
+                )
+            ),
+        )
+
+    def chat_events(self, secondary_username: str):
+        first_message_id = flask.request.args.get("first", 0, type=int)
+        last_message_id = flask.request.args.get("after", 0, type=int)
+        # browsers send the id of the last event they got when reconnecting, which has
+        # the messages they have since. anything that isn't one falls back to the query
+        # string, which is from when the page was loaded
+        event_window = _parse_event_id(flask.request.headers.get("Last-Event-ID", ""))
+        if event_window != None:
+            first_message_id, last_message_id = event_window
+
+        def event_stream():
+            nonlocal first_message_id, last_message_id
+
+            # None until it caught up on whatever happened before the stream was opened
+            messages = None
+            while True:
+                try:
+                    if messages == None:
+                        messages = _get_raw_messages(
+                            self.__connection, secondary_username, last_message_id
+                        )
+                    if len(messages) == 0:
+                        # comments keep the connection from being closed as idle
+                        yield ": keepalive\n\n"
+                    else:
+                        rendered_messages, first_message_id, last_message_id = (
+                            _render_appended_messages(
+                                self.__connection,
+                                secondary_username,
+                                first_message_id,
+                                last_message_id,
+                                messages,
+                            )
+                        )
+                        yield f"id: {first_message_id}:{last_message_id}\nevent: message\n" + "".join(
+                            f"data: {line}\n" for line in rendered_messages.splitlines()
+                        ) + "\n"
+                except (TimeoutError, ConnectionError):
+                    # the connection to the server is reconnecting, the stream stays open
+                    # and catches up once it's back
+                    messages = None
+                    yield ": keepalive\n\n"
+                    time.sleep(CLIENT_CONFIG["gui"]["sse_keepalive_interval"])
+                    continue
+
+                messages = self.__connection.wait_for_new_messages(
+                    secondary_username,
+                    last_message_id,
+                    CLIENT_CONFIG["gui"]["sse_keepalive_interval"],
+                )
+
+        return flask.Response(
+            flask.stream_with_context(event_stream()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
         )
 
     def send_message(self):
-        self.__connection.add_input_event_and_wait_for_response(
-            InputEvents.SendMessage(
-                generate_random_event_id(),
-                flask.request.form["receiver"],
-                flask.request.form["content"],
-            )
+        # answered before the server has the message, it shows up as pending until then
+        send_message_event = InputEvents.SendMessage(
+            generate_event_id(),
+            flask.request.form["receiver"],
+            flask.request.form["content"],
         )
-        return flask.Response(status=200, headers={"HX-Refresh": "true"})
+        self.__connection.add_input_event_for_response(send_message_event)
+
+        return flask.render_template(
+            "chat_message_pending.jinja2",
+            event_id=send_message_event.id,
+            msg={
+                "sender": self.__connection.username,
+                "content": send_message_event.content,
+                "time_sent": prettify_time(time.time()),
+            },
+        ) + flask.render_template("chat_send_content_field.jinja2", out_of_band=True)
+
+    def send_message_status(self, event_id: int):
+        try:
+            self.__connection.wait_for_response(event_id)
+        except (TimeoutError, ConnectionError):
+            return flask.Response(
+                " - failed to send",
+                headers={
+                    "HX-Retarget": f"#chatMessagePendingStatus-{event_id}",
+                    "HX-Reswap": "innerHTML",
+                },
+            )
+
+        # the live updates normally replace it before this does
+        return flask.Response(status=200)
 
     def add_friend(self):
+        username = flask.request.form["username"]
+        previous_relation = self.__get_relation(username)
         response = self.__connection.add_input_event_and_wait_for_response(
-            InputEvents.AddFriend(
-                generate_random_event_id(), flask.request.form["username"]
-            )
+            InputEvents.AddFriend(generate_event_id(), username)
         )
-        return flask.Response(
-            (
-                "Successfully sent friend request"
-                if response.success  # type: ignore
-                else "Failed to send friend request"
-            ),
-            headers={"HX-Refresh": "true"},
+        if not response.success:  # type: ignore
+            return "Failed to send friend request"
+
+        return flask.render_template(
+            "friend_relation_changed.jinja2",
+            result="Successfully sent friend request",
+            changes=[
+                {
+                    "previous_relation": previous_relation,
+                    "relation": self.__get_relation(username),
+                }
+            ],
         )
 
     def remove_friend(self):
+        username = flask.request.form["username"]
+        previous_relation = self.__get_relation(username)
         self.__connection.add_input_event_and_wait_for_response(
-            InputEvents.RemoveFriend(
-                generate_random_event_id(), flask.request.form["username"]
-            )
+            InputEvents.RemoveFriend(generate_event_id(), username)
         )
-        return flask.Response(status=200, headers={"HX-Refresh": "true"})
+
+        return flask.render_template(
+            "friend_relation_changed.jinja2",
+            result=f"Removed {username}",
+            changes=[
+                {
+                    "previous_relation": previous_relation,
+                    "relation": self.__get_relation(username),
+                }
+            ],
+        )
+
+    def update_friends(self):
+        # everything ticked on the friends page, sent to the server as one request
+        usernames = flask.request.form.getlist("usernames")
+        add = flask.request.form.get("action") == "add"
+        if len(usernames) == 0:
+            return "Nothing selected"
+
+        previous_relations = self.__get_relations()
+        results = self.__connection.add_input_event_and_wait_for_response(
+            InputEvents.UpdateFriends(generate_event_id(), usernames, add)
+        ).results  # type: ignore
+        relations = self.__get_relations()
+
+        updated_usernames = [
+            username for username, success in zip(usernames, results) if success
+        ]
+        failed_usernames = [
+            username for username, success in zip(usernames, results) if not success
+        ]
+        result = f"{'Accepted' if add else 'Removed'} {len(updated_usernames)}"
+        if len(failed_usernames) > 0:
+            result += f", couldn't update {', '.join(failed_usernames)}"
+
+        return flask.render_template(
+            "friend_relation_changed.jinja2",
+            result=result,
+            changes=[
+                {
+                    "previous_relation": previous_relations.get(username),
+                    "relation": relations.get(username),
+                }
+                for username in updated_usernames
+            ],
+        )
+
+    def __get_relation(self, secondary_username: str) -> Relation | None:
+        return self.__get_relations().get(secondary_username)
+
+    def __get_relations(self) -> dict[str, Relation]:
+        # answered from the connection's cache unless they just changed
+        return {
+            relation.secondary_username: relation
+            for relation in self.__connection.add_input_event_and_wait_for_response(
+                InputEvents.GetRelations(generate_event_id())
+            ).relations  # type: ignore
+        }
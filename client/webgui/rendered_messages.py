@@ -0,0 +1,55 @@
+from shared.items import Message
+
+import collections
+import threading
+import datetime
+import markupsafe
+import jinja2
+
+
+class RenderedMessages:
+    def __init__(self, template: jinja2.Template, max_size: int) -> None:
+        # messages never change once sent, so their html only has to be made once
+        self.__template = template
+        self.__max_size = max_size
+        self.__fragments: collections.OrderedDict[int, markupsafe.Markup] = (
+            collections.OrderedDict()
+        )
+        self.__lock = threading.Lock()
+
+    def render(self, messages: list[Message]) -> list[markupsafe.Markup]:
+        fragments = []
+        for message in messages:
+            with self.__lock:
+                fragment = self.__fragments.get(message.id)
+                if fragment != None:
+                    self.__fragments.move_to_end(message.id)
+            if fragment == None:
+                fragment = self.__render_message(message)
+                self.__add(message.id, fragment)
+            fragments.append(fragment)
+
+        return fragments
+
+    def __render_message(self, message: Message) -> markupsafe.Markup:
+        return markupsafe.Markup(
+            self.__template.render(
+                msg={
+                    "id": message.id,
+                    "sender": message.sender,
+                    "content": message.content,
+                    "time_sent": prettify_time(message.time_sent),
+                }
+            )
+        )
+
+    def __add(self, message_id: int, fragment: markupsafe.Markup) -> None:
+        with self.__lock:
+            self.__fragments[message_id] = fragment
+            self.__fragments.move_to_end(message_id)
+            while len(self.__fragments) > self.__max_size:
+                self.__fragments.popitem(last=False)
+
+
+def prettify_time(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
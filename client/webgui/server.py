@@ -0,0 +1,292 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.wsgi import LimitedStream
+from wsgiref import simple_server
+
+import collections
+import selectors
+import threading
+import logging
+import socket
+import time
+
+
+class _KeepAliveServerHandler(simple_server.ServerHandler):
+    http_version = "1.1"
+
+    def cleanup_headers(self) -> None:
+        super().cleanup_headers()
+        # without a length, the end of the response is the end of the connection
+        if "Content-Length" not in self.headers:
+            self.request_handler.close_connection = True  # type: ignore
+        if self.request_handler.close_connection:  # type: ignore
+            self.headers["Connection"] = "close"
+
+
+class _KeepAliveRequestHandler(simple_server.WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: PooledWSGIServer
+
+    def setup(self) -> None:
+        # the server's, a request that stops halfway is given up on after this long
+        self.timeout = self.server.keep_alive_timeout
+        super().setup()
+        # the headers and the body are written separately, nagle's algorithm would hold
+        # the body back until the headers are acked, which takes ~40 ms on a kept alive
+        # connection
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self) -> None:
+        # only one request, the server decides where the next one on the connection is
+        # handled, and where event streams run
+        self.close_connection = True
+        self.is_event_stream = False
+        try:
+            if not self.__read_request():
+                return
+        except (TimeoutError, ConnectionError):
+            self.close_connection = True  # the browser is gone
+            return
+
+        # they stay open for as long as the page does, so they can't hold a worker
+        self.is_event_stream = "text/event-stream" in self.headers.get("Accept", "")
+        if not self.is_event_stream:
+            self.run_request()
+
+    def run_request(self) -> None:
+        # whatever the app doesn't read of the body is skipped, so the next request
+        # on the connection starts where it should
+        request_body = LimitedStream(
+            self.rfile, int(self.headers.get("Content-Length") or 0)
+        )
+        handler = _KeepAliveServerHandler(
+            request_body,
+            self.wfile,
+            self.get_stderr(),
+            self.get_environ(),
+            multithread=True,
+        )
+        handler.request_handler = self  # type: ignore
+        try:
+            handler.run(self.server.get_app())  # type: ignore
+            request_body.exhaust()
+        except (TimeoutError, ConnectionError):
+            self.close_connection = True
+
+    def has_buffered_request(self) -> bool:
+        # a request that is already read into rfile's buffer doesn't make the socket
+        # readable, so it would never be noticed while waiting for the next one
+        self.connection.setblocking(False)
+        try:
+            return len(self.rfile.peek(1)) > 0  # type: ignore
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True  # handling it notices the connection is broken
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def finish(self) -> None:
+        # the server closes the connection once it's done with it, see close
+        pass
+
+    def close(self) -> None:
+        super().finish()
+
+    def __read_request(self) -> bool:
+        # False if there is no request to run
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) == 0:
+            return False
+        if len(self.raw_requestline) > 65536:
+            self.send_error(414)
+            self.close_connection = True
+            return False
+        # sends the error response itself
+        return self.parse_request()
+
+    def log_message(self, format: str, *args) -> None:
+        # every request is logged, don't format it for nothing
+        logger = logging.getLogger("WebGUIServer")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class PooledWSGIServer(simple_server.WSGIServer):
+    # the workers only handle requests. idle keep-alive connections wait in a selector
+    # until the next request comes, and event streams have a thread each, so neither
+    # keeps the other requests waiting. max_connections is the limit on all of them
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        app,
+        worker_threads: int,
+        max_queued_connections: int,
+        max_connections: int,
+        keep_alive_timeout: float,
+    ) -> None:
+        self.request_queue_size = max_queued_connections
+        super().__init__((host, port), _KeepAliveRequestHandler)
+        self.set_app(app)
+
+        # idle keep-alive connections are closed after this long
+        self.keep_alive_timeout = keep_alive_timeout
+
+        self.__logger = logging.getLogger("WebGUIServer")
+        self.__workers = ThreadPoolExecutor(
+            worker_threads, thread_name_prefix="WebGUIWorker"
+        )
+        self.__connection_slots = threading.BoundedSemaphore(max_connections)
+
+        self.__running = True
+        # connection -> when it is closed if no request comes before then
+        self.__idle_connections: dict[_KeepAliveRequestHandler, float] = {}
+        self.__idle_selector = selectors.DefaultSelector()
+        # only the idle connections thread touches the selector, the others queue here
+        self.__connections_to_make_idle: collections.deque[_KeepAliveRequestHandler] = (
+            collections.deque()
+        )
+        self.__wakeup_reader, self.__wakeup_writer = socket.socketpair()
+        self.__wakeup_reader.setblocking(False)
+        self.__wakeup_writer.setblocking(False)
+        self.__idle_selector.register(self.__wakeup_reader, selectors.EVENT_READ)
+        threading.Thread(
+            target=self.__watch_idle_connections,
+            name="WebGUIIdleConnections",
+            daemon=True,
+        ).start()
+
+    def process_request(self, request, client_address) -> None:
+        if not self.__connection_slots.acquire(blocking=False):
+            self.__logger.warning(
+                "Too many connections, rejecting one (address: %s:%s)",
+                *client_address,
+            )
+            self.__reject_request(request)
+            return
+
+        self.__workers.submit(self.__handle_new_connection, request, client_address)
+
+    def __handle_new_connection(self, request, client_address) -> None:
+        try:
+            # handles the first request
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            self.__connection_slots.release()
+            return
+        self.__after_request(handler)  # type: ignore
+
+    def __handle_next_request(self, handler: _KeepAliveRequestHandler) -> None:
+        try:
+            handler.handle()
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+            handler.close_connection = True
+        self.__after_request(handler)
+
+    def __handle_event_stream(self, handler: _KeepAliveRequestHandler) -> None:
+        try:
+            handler.run_request()
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+            handler.close_connection = True
+        handler.is_event_stream = False
+        self.__after_request(handler)
+
+    def __after_request(self, handler: _KeepAliveRequestHandler) -> None:
+        if handler.is_event_stream:
+            threading.Thread(
+                target=self.__handle_event_stream,
+                args=[handler],
+                name="WebGUIEventStream",
+                daemon=True,
+            ).start()
+        elif handler.close_connection or not self.__running:
+            self.__close_connection(handler)
+        elif handler.has_buffered_request():
+            self.__workers.submit(self.__handle_next_request, handler)
+        else:
+            self.__connections_to_make_idle.append(handler)
+            self.__wake_up()
+
+    def __watch_idle_connections(self) -> None:
+        while self.__running:
+            next_timeout = min(self.__idle_connections.values(), default=None)
+            for key, _ in self.__idle_selector.select(
+                max(next_timeout - time.monotonic(), 0)
+                if next_timeout != None
+                else None
+            ):
+                if key.fileobj == self.__wakeup_reader:
+                    self.__drain_wakeups()
+                    continue
+
+                # the next request came, or the browser closed it
+                self.__idle_selector.unregister(key.fileobj)
+                del self.__idle_connections[key.data]
+                self.__workers.submit(self.__handle_next_request, key.data)
+
+            while len(self.__connections_to_make_idle) > 0:
+                handler = self.__connections_to_make_idle.popleft()
+                self.__idle_selector.register(
+                    handler.connection, selectors.EVENT_READ, handler
+                )
+                self.__idle_connections[handler] = (
+                    time.monotonic() + self.keep_alive_timeout
+                )
+
+            now = time.monotonic()
+            for handler, timeout in list(self.__idle_connections.items()):
+                if timeout <= now:
+                    self.__idle_selector.unregister(handler.connection)
+                    del self.__idle_connections[handler]
+                    self.__close_connection(handler)
+
+        for handler in list(self.__idle_connections):
+            self.__close_connection(handler)
+        self.__idle_selector.close()
+
+    def __close_connection(self, handler: _KeepAliveRequestHandler) -> None:
+        try:
+            handler.close()
+        except OSError:
+            pass
+        self.shutdown_request(handler.request)
+        self.__connection_slots.release()
+
+    def __wake_up(self) -> None:
+        try:
+            self.__wakeup_writer.send(b"\x00")
+        except BlockingIOError:
+            pass  # there already are wake ups waiting to be read
+
+    def __drain_wakeups(self) -> None:
+        try:
+            while True:
+                self.__wakeup_reader.recv(4096)
+        except BlockingIOError:
+            pass
+
+    def __reject_request(self, request: socket.socket) -> None:
+        try:
+            request.settimeout(1)
+            request.sendall(
+                b"HTTP/1.1 503 Service Unavailable\r\n"
+                b"Content-Length: 0\r\n"
+                b"Retry-After: 1\r\n"
+                b"Connection: close\r\n\r\n"
+            )
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.__running = False
+        self.__wake_up()
+        self.__workers.shutdown(wait=False, cancel_futures=True)
@@ -1,14 +1,30 @@
+from shared.metrics import start_metrics_server
 from shared.logger import configure_logger
+from server.admin import start_admin_server
+from shared.config import SERVER_CONFIG
+from shared.tracing import TRACER
 from server import Server
 
-import logging
 
-
-configure_logger(logging.DEBUG)
+configure_logger(SERVER_CONFIG["logging"]["level"])
 
 
 def main() -> None:
+    if SERVER_CONFIG["metrics"]["enabled"]:
+        start_metrics_server(
+            SERVER_CONFIG["metrics"]["listen_address"],
+            SERVER_CONFIG["metrics"]["listen_port"],
+        )
+    if SERVER_CONFIG["tracing"]["enabled"]:
+        TRACER.configure(SERVER_CONFIG["tracing"]["filepath"])
     server = Server()
+    if SERVER_CONFIG["admin"]["enabled"]:
+        start_admin_server(
+            SERVER_CONFIG["admin"]["listen_address"],
+            SERVER_CONFIG["admin"]["listen_port"],
+            SERVER_CONFIG["admin"]["token"],
+            server,
+        )
     server.run()
 
 
@@ -0,0 +1,272 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from shared.config import SERVER_CONFIG
+from .profiler import SamplingProfiler
+from urllib.parse import urlsplit
+
+if TYPE_CHECKING:
+    from .client_handler import Server
+
+import threading
+import logging
+import hmac
+import json
+import time
+import os
+
+
+class AdminServer(ThreadingHTTPServer):
+    # an http api for operators, every request needs the admin token
+    daemon_threads = True
+
+    def __init__(
+        self, address: str, port: int, token: str, chat_server: Server
+    ) -> None:
+        super().__init__((address, port), _AdminRequestHandler)
+        self.token = token
+        self.chat_server = chat_server
+        self.profiler = SamplingProfiler()
+        # peer address -> (time, requests, bytes received, bytes sent) at the last
+        # snapshot, so the rates are for the time since
+        self.__previous_session_counters: dict[str, tuple[float, int, int, int]] = {}
+        self.__snapshot_lock = threading.Lock()
+
+    def get_snapshot(self) -> dict:
+        # only reads what the server keeps anyway, so it can be polled often
+        now = time.time()
+        sessions = sorted(
+            list(self.chat_server.clients), key=lambda client: client.connect_time
+        )
+        with self.__snapshot_lock:
+            previous_session_counters = self.__previous_session_counters
+            self.__previous_session_counters = {}
+            session_snapshots = []
+            for client in sessions:
+                packet_sock = client.packet_socket
+                counters = (
+                    now,
+                    client.requests_handled,
+                    packet_sock.bytes_received,
+                    packet_sock.bytes_sent,
+                )
+                self.__previous_session_counters[client.peer_address] = counters
+                # since the session started, if this is the first snapshot it's in
+                previous_counters = previous_session_counters.get(
+                    client.peer_address, (client.connect_time, 0, 0, 0)
+                )
+                elapsed_time = max(now - previous_counters[0], 1e-9)
+                session_snapshots.append(
+                    {
+                        "peer_address": client.peer_address,
+                        "username": client.username,
+                        "authenticated": client.authenticated,
+                        "connected_seconds": now - client.connect_time,
+                        "idle_seconds": now - client.last_activity_time,
+                        "requests": client.requests_handled,
+                        "packets_received": packet_sock.packets_received,
+                        "packets_sent": packet_sock.packets_sent,
+                        "bytes_received": packet_sock.bytes_received,
+                        "bytes_sent": packet_sock.bytes_sent,
+                        "requests_per_second": (counters[1] - previous_counters[1])
+                        / elapsed_time,
+                        "bytes_received_per_second": (
+                            counters[2] - previous_counters[2]
+                        )
+                        / elapsed_time,
+                        "bytes_sent_per_second": (counters[3] - previous_counters[3])
+                        / elapsed_time,
+                        "handling_request": client.handling_time != None,
+                        "handling_seconds": client.handling_time,
+                        "database_seconds": client.db_time_spent,
+                    }
+                )
+
+        # every session has its own database connection, and the server one more
+        busy_connections = len(
+            [
+                session
+                for session in session_snapshots
+                if session["handling_seconds"] != None
+            ]
+        )
+        recent_idempotency_keys = self.chat_server.recent_idempotency_keys
+        idempotency_lookups = (
+            recent_idempotency_keys.hits + recent_idempotency_keys.misses
+        )
+        return {
+            "time": now,
+            "uptime_seconds": now - self.chat_server.start_time,
+            "sessions": session_snapshots,
+            "online_users": len(
+                {
+                    session["username"]
+                    for session in session_snapshots
+                    if session["authenticated"]
+                }
+            ),
+            "database": {
+                "connections": len(sessions) + 1,
+                "busy_connections": busy_connections,
+                "utilization": busy_connections / (len(sessions) + 1),
+                "slowest_request_in_progress_seconds": max(
+                    [session["handling_seconds"] or 0 for session in session_snapshots],
+                    default=0,
+                ),
+            },
+            "caches": {
+                "idempotency_keys": {
+                    "size": len(recent_idempotency_keys),
+                    "max_size": recent_idempotency_keys.max_size,
+                    "hits": recent_idempotency_keys.hits,
+                    "misses": recent_idempotency_keys.misses,
+                    "hit_rate": (
+                        recent_idempotency_keys.hits / idempotency_lookups
+                        if idempotency_lookups > 0
+                        else None
+                    ),
+                },
+            },
+            "threads": {
+                "count": threading.active_count(),
+                # how much later than asked for a sleeping thread got to run again
+                "idle_reaper_lag_seconds": self.chat_server.reaper_lag,
+            },
+        }
+
+
+class _AdminRequestHandler(BaseHTTPRequestHandler):
+    server: AdminServer
+
+    def do_GET(self) -> None:
+        self.__handle("GET")
+
+    def do_POST(self) -> None:
+        self.__handle("POST")
+
+    def __handle(self, method: str) -> None:
+        if not hmac.compare_digest(
+            self.headers.get("Authorization", "").encode(),
+            f"Bearer {self.server.token}".encode(),
+        ):
+            self.__send_json(401, {"error": "wrong or missing admin token"})
+            return
+
+        try:
+            body = self.__read_json_body()
+        except ValueError:
+            self.__send_json(400, {"error": "the body isn't a json object"})
+            return
+
+        match (method, urlsplit(self.path).path):
+            case ("GET", "/snapshot"):
+                self.__send_json(200, self.server.get_snapshot())
+            case ("GET", "/slow_log"):
+                self.__send_json(200, SERVER_CONFIG["slow_log"])
+            case ("POST", "/slow_log"):
+                self.__set_slow_log_thresholds(body)
+            case ("GET", "/profile"):
+                self.__send_json(
+                    200,
+                    {
+                        "running": self.server.profiler.running,
+                        "output_path": self.server.profiler.output_path,
+                    },
+                )
+            case ("POST", "/profile"):
+                self.__start_profiling(body)
+            case _:
+                self.__send_json(404, {"error": "no such endpoint"})
+
+    def __set_slow_log_thresholds(self, thresholds: dict) -> None:
+        for key, value in thresholds.items():
+            if key not in SERVER_CONFIG["slow_log"]:
+                self.__send_json(400, {"error": f"unknown threshold '{key}'"})
+                return
+            if (
+                isinstance(value, bool)
+                or not isinstance(value, (int, float))
+                or value < 0
+            ):
+                self.__send_json(400, {"error": f"'{key}' must be a number of seconds"})
+                return
+
+        # the config is read on every statement and request, so this applies right away
+        SERVER_CONFIG["slow_log"].update(thresholds)
+        logging.getLogger("AdminServer").info(
+            "Changed slow log thresholds to %s", SERVER_CONFIG["slow_log"]
+        )
+        self.__send_json(200, SERVER_CONFIG["slow_log"])
+
+    def __start_profiling(self, options: dict) -> None:
+        duration = options.get("seconds", SERVER_CONFIG["profiler"]["default_duration"])
+        rate = options.get("rate", SERVER_CONFIG["profiler"]["default_rate"])
+        for key, value, max_value in [
+            ("seconds", duration, SERVER_CONFIG["profiler"]["max_duration"]),
+            ("rate", rate, SERVER_CONFIG["profiler"]["max_rate"]),
+        ]:
+            if (
+                isinstance(value, bool)
+                or not isinstance(value, (int, float))
+                or value <= 0
+            ):
+                self.__send_json(400, {"error": f"'{key}' must be a positive number"})
+                return
+            if value > max_value:
+                self.__send_json(
+                    400, {"error": f"'{key}' can't be more than {max_value}"}
+                )
+                return
+
+        output_path = os.path.join(
+            SERVER_CONFIG["profiler"]["output_directory"],
+            time.strftime("profile-%Y%m%d-%H%M%S.folded"),
+        )
+        if not self.server.profiler.start(duration, rate, output_path):
+            self.__send_json(409, {"error": "already profiling"})
+            return
+        # the file is only written when it's done
+        self.__send_json(
+            202, {"seconds": duration, "rate": rate, "output_path": output_path}
+        )
+
+    def __read_json_body(self) -> dict:
+        content_length = int(self.headers.get("Content-Length", 0))
+        if content_length == 0:
+            return {}
+        body = json.loads(self.rfile.read(content_length))
+        if not isinstance(body, dict):
+            raise ValueError("the body must be a json object")
+        return body
+
+    def __send_json(self, status: int, body) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        logger = logging.getLogger("AdminServer")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def start_admin_server(
+    address: str, port: int, token: str, chat_server: Server
+) -> AdminServer:
+    logger = logging.getLogger("AdminServer")
+    if len(token) == 0:
+        token = os.urandom(16).hex()
+        logger.warning("No admin token configured, using %s", token)
+
+    admin_server = AdminServer(address, port, token, chat_server)
+    threading.Thread(
+        target=admin_server.serve_forever, name="AdminServer", daemon=True
+    ).start()
+    logger.info(
+        "Serving the admin api on http://%s:%s", *admin_server.server_address[:2]
+    )
+    return admin_server
@@ -1,9 +1,18 @@
 from .client_stuff import ServerSideClient
+from shared.packets import ServerPackets
+from shared.metrics import METRICS_REGISTRY
 from shared.config import SERVER_CONFIG
+from shared.items import Message
+from .idempotency import RecentIdempotencyKeys
+from .resume_tickets import ResumeTicketSigner
+from .timing_wheel import TimingWheel
 from .db_handler import DBWrapper
 
+import threading
 import logging
 import socket
+import math
+import time
 import sys
 
 
@@ -19,8 +28,35 @@ class Server:
         self.__logger.info("Initialized server socket")
 
         self.__running = False
-        self.__clients: list[ServerSideClient] = []
+        self.__start_time = time.time()
+        # how late the idle reaper woke up last time, a sign of how busy the process is
+        self.__reaper_lag = 0.0
+        self.__clients: set[ServerSideClient] = set()
+        self.__clients_by_username: dict[str, set[ServerSideClient]] = {}
+        self.__clients_lock = threading.Lock()
+        self.__connections_gauge = METRICS_REGISTRY.gauge(
+            "chat_server_connections", "Open client connections"
+        )
+        self.__online_users_gauge = METRICS_REGISTRY.gauge(
+            "chat_server_online_users", "Users with at least one authenticated session"
+        )
+        # clients are checked for being idle when their slot in the wheel comes up
+        self.__idle_clients_wheel: TimingWheel[ServerSideClient] = TimingWheel(
+            SERVER_CONFIG["connection"]["idle_check_interval"],
+            math.ceil(
+                SERVER_CONFIG["connection"]["idle_timeout"]
+                / SERVER_CONFIG["connection"]["idle_check_interval"]
+            )
+            + 1,
+        )
         self.__db_wrapper = DBWrapper()
+        self.__recent_idempotency_keys = RecentIdempotencyKeys(
+            SERVER_CONFIG["database"]["idempotency_cache_size"]
+        )
+        self.__resume_ticket_signer = ResumeTicketSigner(
+            SERVER_CONFIG["connection"]["resume_ticket_secret"],
+            SERVER_CONFIG["connection"]["resume_ticket_lifetime"],
+        )
         self.__logger.debug("Ensuring database tables")
         self.__db_wrapper.ensure_tables()
         self.__logger.debug("Ensured database tables")
@@ -28,6 +64,10 @@ class Server:
     def run(self) -> None:
         self.__running = True
 
+        threading.Thread(
+            target=self.__reap_idle_clients, name="IdleClientReaper", daemon=True
+        ).start()
+
         self.__logger.info(
             "Now accepting connections on %s:%s", *self.__sock.getsockname()
         )
@@ -43,18 +83,94 @@ class Server:
             )
             new_client_sock.setblocking(False)
             new_client = ServerSideClient(new_client_sock, self)
+            with self.__clients_lock:
+                self.__clients.add(new_client)
+                self.__connections_gauge.set(len(self.__clients))
+            self.__idle_clients_wheel.schedule(
+                new_client, SERVER_CONFIG["connection"]["idle_timeout"]
+            )
             new_client.start()
-            self.__clients.append(new_client)
 
         self.__logger.info("Stopping server")
         self.__logger.debug("Stopping all client threads")
-        for client in self.__clients:
+        for client in list(self.__clients):
             client.stop(self.__send_quit)
 
     def stop(self, send_quit: bool = True) -> None:
         self.__send_quit = send_quit
         self.__running = False
 
+    def add_authenticated_client(self, client: ServerSideClient) -> None:
+        with self.__clients_lock:
+            self.__clients_by_username.setdefault(client.username, set()).add(client)  # type: ignore
+            self.__online_users_gauge.set(len(self.__clients_by_username))
+
+    def remove_client(self, client: ServerSideClient) -> None:
+        with self.__clients_lock:
+            self.__clients.discard(client)
+            user_clients = self.__clients_by_username.get(client.username, set())  # type: ignore
+            user_clients.discard(client)
+            if len(user_clients) == 0:
+                self.__clients_by_username.pop(client.username, None)  # type: ignore
+            self.__connections_gauge.set(len(self.__clients))
+            self.__online_users_gauge.set(len(self.__clients_by_username))
+
+    def push_message(self, message: Message) -> None:
+        for client in self.__get_clients_of_users([message.sender, message.receiver]):
+            new_message_packet = ServerPackets.NewMessage()
+            new_message_packet.init_packet_from_params([message])
+            try:
+                client.packet_socket.send(new_message_packet)
+            except OSError:
+                self.__disconnect_after_failed_push(client)
+
+    def push_relations_changed(self, usernames: list[str]) -> None:
+        for client in self.__get_clients_of_users(usernames):
+            try:
+                client.packet_socket.send(ServerPackets.RelationsChanged())
+            except OSError:
+                self.__disconnect_after_failed_push(client)
+
+    def __disconnect_after_failed_push(self, client: ServerSideClient) -> None:
+        # the push could have been partly sent, which would garble everything sent after it
+        self.__logger.warning(
+            "Disconnecting client after a failed push (thread: %s)", client.name
+        )
+        client.disconnect()
+
+    def __get_clients_of_users(self, usernames: list[str]) -> set[ServerSideClient]:
+        with self.__clients_lock:
+            return set().union(
+                *[
+                    self.__clients_by_username.get(username, set())
+                    for username in usernames
+                ]
+            )
+
+    def __reap_idle_clients(self) -> None:
+        idle_timeout = SERVER_CONFIG["connection"]["idle_timeout"]
+
+        while self.__running:
+            wake_up_time = time.perf_counter() + self.__idle_clients_wheel.tick_duration
+            time.sleep(self.__idle_clients_wheel.tick_duration)
+            self.__reaper_lag = max(time.perf_counter() - wake_up_time, 0)
+            for client in self.__idle_clients_wheel.tick():
+                if client not in self.__clients:
+                    continue  # already gone
+
+                idle_time = time.time() - client.last_activity_time
+                if idle_time < idle_timeout:
+                    # it has been active since, so check again when it could be idle for long enough
+                    self.__idle_clients_wheel.schedule(client, idle_timeout - idle_time)
+                    continue
+
+                self.__logger.info(
+                    "Disconnecting idle client (thread: %s, idle_time: %.1f seconds)",
+                    client.name,
+                    idle_time,
+                )
+                client.stop(send_quit=False)
+
     def __create_and_bind_socket(self, address: str, port: int) -> None:
         self.__sock = socket.socket()
         if sys.platform != "win32":
@@ -64,9 +180,29 @@ class Server:
         self.__sock.setblocking(True)
 
     @property
-    def clients(self) -> list[ServerSideClient]:
+    def address(self) -> tuple[str, int]:
+        return self.__sock.getsockname()
+
+    @property
+    def clients(self) -> set[ServerSideClient]:
         return self.__clients
 
+    @property
+    def start_time(self) -> float:
+        return self.__start_time
+
+    @property
+    def reaper_lag(self) -> float:
+        return self.__reaper_lag
+
     @property
     def db_wrapper(self) -> DBWrapper:
         return self.__db_wrapper
+
+    @property
+    def recent_idempotency_keys(self) -> RecentIdempotencyKeys:
+        return self.__recent_idempotency_keys
+
+    @property
+    def resume_ticket_signer(self) -> ResumeTicketSigner:
+        return self.__resume_ticket_signer
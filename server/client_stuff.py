@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Callable
 
 from shared.packets import (
     ServerPackets,
@@ -8,8 +8,11 @@ from shared.packets import (
     PacketType,
     Packet,
 )
+from shared.logger import ConnectionLoggerAdapter
 from shared.packet_socket import PacketSocket
+from shared.metrics import METRICS_REGISTRY
 from server.db_handler import DBWrapper
+from shared.tracing import TRACER
 from shared.config import SERVER_CONFIG
 
 if TYPE_CHECKING:
@@ -17,6 +20,7 @@ if TYPE_CHECKING:
 
 import threading
 import logging
+import select
 import socket
 import time
 
@@ -26,64 +30,105 @@ class ServerSideClient(threading.Thread):
         super().__init__(
             name=f"ChatServerSideClient (Address: {sock.getpeername()[0]})"
         )
-        self.__logger = logging.getLogger(
-            f"Client {sock.getpeername()[0]}:{sock.getpeername()[1]}"
+        self.__peer_address = f"{sock.getpeername()[0]}:{sock.getpeername()[1]}"
+        self.__logger = ConnectionLoggerAdapter(
+            logging.getLogger("ServerSideClient"), self.__peer_address
         )
 
         self.__packet_sock = PacketSocket(sock)
         self.__pending_packets = []
+        # pushes to other sessions caused by the request being handled, they are sent
+        # after its response so they don't hold it back
+        self.__pushes_after_response: list[Callable[[], None]] = []
         self.__server_thread = server_thread
         self.__authenticated = False
         self.__username = None
 
         self.__running = False
         self.__send_quit = False
+        self.__connect_time = time.time()
+        self.__last_activity_time = time.time()
+        # made in the client's own thread, sqlite connections can't change threads
+        self.__db_wrapper: DBWrapper = None  # type: ignore
+        self.__requests_handled = 0
+        # when the request being handled right now started being handled
+        self.__handle_start_time: float | None = None
 
     def run(self) -> None:
+        try:
+            self.__run()
+        finally:
+            # however the session ended, the server shouldn't hold on to it
+            self.__server_thread.remove_client(self)
+            self.__packet_sock.raising_socket.close()
+
+    def __run(self) -> None:
         self.__running = True
         self.__db_wrapper = DBWrapper()
 
         # authenticate
-        start_time = time.time()
+        max_authentication_time = (
+            time.time() + SERVER_CONFIG["connection"]["authentication_timeout"]
+        )
         self.__logger.debug("Waiting for authentication packet")
         while self.__running:
-            if (
-                time.time()
-                > start_time + SERVER_CONFIG["connection"]["authentication_timeout"]
-            ):
+            remaining_time = max_authentication_time - time.time()
+            if remaining_time <= 0:
                 self.__logger.info("Authentication timeout reached")
                 self.stop(send_quit=False)
                 break
 
             try:
-                time.sleep(0.1)
-                auth_packet: ClientPackets.Authenticate = self.__packet_sock.recv()  # type: ignore
-                if auth_packet.type != PacketType.client_authenticate:
-                    self.__logger.error("Client sent invalid first packet")
-                    error_packet = SharedPackets.InvalidPacketType(auth_packet.id)
-                    error_packet.init_packet_from_params(
-                        [PacketType.client_authenticate]
-                    )
-                    self.__packet_sock.send(error_packet)
-                    self.stop(send_quit=False)
-                    break
-
-                self.__authenticated, self.__username = self.__db_wrapper.check_token(
-                    auth_packet.token
+                # handle the authentication packet as soon as it arrives
+                select.select(
+                    [self.__packet_sock.raising_socket], [], [], remaining_time
                 )
+                auth_packet = self.__packet_sock.recv()
+                self.__last_activity_time = time.time()
+                match auth_packet.type:
+                    case PacketType.client_authenticate:
+                        self.__authenticated, self.__username = self.__db_wrapper.check_token(auth_packet.token)  # type: ignore
+                    case PacketType.client_resume_session:
+                        # no database lookup needed, the ticket is signed by this server
+                        self.__username = self.__server_thread.resume_ticket_signer.verify(auth_packet.resume_ticket)  # type: ignore
+                        self.__authenticated = self.__username != None
+                    case _:
+                        self.__logger.error("Client sent invalid first packet")
+                        error_packet = SharedPackets.InvalidPacketType(auth_packet.id)
+                        error_packet.init_packet_from_params(
+                            [
+                                PacketType.client_authenticate,
+                                PacketType.client_resume_session,
+                            ]
+                        )
+                        self.__packet_sock.send(error_packet)
+                        self.stop(send_quit=False)
+                        break
 
                 response_packet = ServerPackets.Authenticate(auth_packet.id)
                 response_packet.init_packet_from_params(
                     self.__authenticated,
                     self.__username if isinstance(self.__username, str) else "",
+                    (
+                        self.__server_thread.resume_ticket_signer.issue(
+                            self.__username  # type: ignore
+                        )
+                        if self.__authenticated
+                        else b""
+                    ),
                 )
                 self.__packet_sock.send(response_packet)
 
                 if not self.__authenticated:
+                    if auth_packet.type == PacketType.client_resume_session:
+                        # the client falls back to authenticating with its token
+                        self.__logger.info("Client sent invalid resume ticket")
+                        continue
                     self.__logger.info("Client sent invalid token")
                     self.stop(send_quit=False)
                     break
                 self.__logger.info("Successfully authenticated")
+                self.__server_thread.add_authenticated_client(self)
                 break
             except BlockingIOError:
                 continue
@@ -94,13 +139,52 @@ class ServerSideClient(threading.Thread):
         # main loop
         while self.__running:
             try:
+                select.select([self.__packet_sock.raising_socket], [], [], 1)
+                receive_start_time = time.perf_counter()
                 packet = self.__packet_sock.recv()
-                response_packet = self.__handle_packet(packet)
-                if response_packet == None:
-                    continue
-                self.__packet_sock.send(response_packet)
+                self.__last_activity_time = time.time()
+                handle_start_time = time.perf_counter()
+                self.__handle_start_time = handle_start_time
+                db_time_spent = self.__db_wrapper.time_spent
+                # only traced if the client sent a trace context with it
+                with TRACER.span(
+                    f"handle {packet.type.name}",
+                    packet.trace_context,
+                    username=self.__username,
+                ):
+                    response_packet = self.__handle_packet(packet)
+                    db_time_spent = self.__db_wrapper.time_spent - db_time_spent
+                    send_start_time = time.perf_counter()
+                    try:
+                        if response_packet != None:
+                            self.__packet_sock.send(response_packet)
+                        end_time = time.perf_counter()
+                    finally:
+                        # also when sending the response failed, the change is already
+                        # in the database
+                        self.__send_pushes_after_response()
+                self.__handle_start_time = None
+                self.__requests_handled += 1
+                METRICS_REGISTRY.histogram(
+                    "chat_server_packet_handle_seconds",
+                    "Time from receiving a packet to having sent the response",
+                    packet_type=packet.type.name,
+                ).observe(end_time - handle_start_time)
+                if (
+                    end_time - receive_start_time
+                    > SERVER_CONFIG["slow_log"]["request_threshold"]
+                ):
+                    self.__logger.warning(
+                        "Slow request (type: %s, id: %s, total: %.1f ms, receiving and decoding: %.1f ms, database: %.1f ms, handling: %.1f ms, encoding and sending: %.1f ms)",
+                        packet.type.name,
+                        packet.id,
+                        (end_time - receive_start_time) * 1000,
+                        (handle_start_time - receive_start_time) * 1000,
+                        db_time_spent * 1000,
+                        (send_start_time - handle_start_time - db_time_spent) * 1000,
+                        (end_time - send_start_time) * 1000,
+                    )
             except BlockingIOError:
-                time.sleep(0.1)
                 continue
             except OSError:
                 self.stop(send_quit=False)
@@ -118,17 +202,17 @@ class ServerSideClient(threading.Thread):
     def __handle_packet(self, input_packet: Packet) -> Packet | None:
         match input_packet.type:
             case PacketType.quit:
-                self.__server_thread.clients.remove(self)
-                self.__packet_sock.raising_socket.close()
                 self.stop(send_quit=False)
                 return None
+            case PacketType.ping:
+                return SharedPackets.Pong(input_packet.id)
             case PacketType.client_get_relations:
                 relations = self.__db_wrapper.get_all_relations(self.__username)  # type: ignore
                 relations_packet = ServerPackets.GetRelations(input_packet.id)
                 relations_packet.init_packet_from_params(relations)
                 return relations_packet
             case PacketType.client_get_messages:
-                messages = self.__db_wrapper.get_messages(self.__username, input_packet.secondary_user, round(time.time() - input_packet.after))  # type: ignore
+                messages = self.__db_wrapper.get_messages(self.__username, input_packet.secondary_user, input_packet.after)  # type: ignore
                 messages_packet = ServerPackets.GetMessages(input_packet.id)
                 messages_packet.init_packet_from_params(messages)
                 return messages_packet
@@ -136,31 +220,101 @@ class ServerSideClient(threading.Thread):
                 add_friend_success = self.__db_wrapper.add_friend(
                     self.__username, input_packet.username  # type: ignore
                 )
+                if add_friend_success:
+                    self.__pushes_after_response.append(
+                        lambda: self.__server_thread.push_relations_changed(
+                            [self.__username, input_packet.username]  # type: ignore
+                        )
+                    )
                 add_friend_response_packet = ServerPackets.AddFriend(input_packet.id)
                 add_friend_response_packet.init_packet_from_params(add_friend_success)
                 return add_friend_response_packet
             case PacketType.client_remove_friend:
-                self.__db_wrapper.remove_friend(
+                if self.__db_wrapper.remove_friend(
                     self.__username, input_packet.username  # type: ignore
-                )
+                ):
+                    self.__pushes_after_response.append(
+                        lambda: self.__server_thread.push_relations_changed(
+                            [self.__username, input_packet.username]  # type: ignore
+                        )
+                    )
                 return ServerPackets.RemoveFriend(input_packet.id)
+            case PacketType.client_update_friends:
+                update_friends_results = self.__db_wrapper.update_friends(
+                    self.__username, input_packet.usernames, input_packet.add  # type: ignore
+                )
+                updated_usernames = [
+                    username
+                    for username, success in zip(input_packet.usernames, update_friends_results)  # type: ignore
+                    if success
+                ]
+                if len(updated_usernames) > 0:
+                    self.__pushes_after_response.append(
+                        lambda: self.__server_thread.push_relations_changed(
+                            [self.__username, *updated_usernames]  # type: ignore
+                        )
+                    )
+                update_friends_response_packet = ServerPackets.UpdateFriends(
+                    input_packet.id
+                )
+                update_friends_response_packet.init_packet_from_params(
+                    update_friends_results
+                )
+                return update_friends_response_packet
             case PacketType.client_send_message:
-                self.__db_wrapper.add_message(self.__username, input_packet.receiver, input_packet.content)  # type: ignore
-                return ServerPackets.SendMessage(input_packet.id)
+                recent_idempotency_keys = self.__server_thread.recent_idempotency_keys
+                message_id = recent_idempotency_keys.get(self.__username, input_packet.idempotency_key)  # type: ignore
+                if message_id == None:
+                    message, is_new = self.__db_wrapper.add_message(self.__username, input_packet.receiver, input_packet.content, input_packet.idempotency_key)  # type: ignore
+                    message_id = message.id
+                    recent_idempotency_keys.add(self.__username, input_packet.idempotency_key, message_id)  # type: ignore
+                else:
+                    is_new = False
+                    self.__logger.debug(
+                        "Ignoring retried message (message_id: %s)", message_id
+                    )
+                send_message_response_packet = ServerPackets.SendMessage(
+                    input_packet.id
+                )
+                send_message_response_packet.init_packet_from_params(message_id)
+                # the sender gets the id before the message is pushed to it, so it knows
+                # the push is the message it just sent
+                if is_new:
+                    self.__pushes_after_response.append(
+                        lambda: self.__server_thread.push_message(message)  # type: ignore
+                    )
+                return send_message_response_packet
             case _:
                 error_packet = SharedPackets.InvalidPacketType(input_packet.id)
                 error_packet.init_packet_from_params(
                     [
                         PacketType.quit,
+                        PacketType.ping,
                         PacketType.client_get_relations,
                         PacketType.client_get_messages,
                         PacketType.client_add_friend,
                         PacketType.client_remove_friend,
+                        PacketType.client_update_friends,
                         PacketType.client_send_message,
                     ]
                 )
                 return error_packet
 
+    def __send_pushes_after_response(self) -> None:
+        pushes = self.__pushes_after_response
+        self.__pushes_after_response = []
+        for push in pushes:
+            push()
+
+    def disconnect(self) -> None:
+        # for other threads, when the connection can't be used anymore, like after
+        # a packet was only partly sent to it
+        self.stop(send_quit=False)
+        try:
+            self.__packet_sock.raising_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # already closed
+
     def stop(self, send_quit: bool = True) -> None:
         self.__send_quit = send_quit
         self.__running = False
@@ -185,3 +339,37 @@ class ServerSideClient(threading.Thread):
     @property
     def authenticated(self) -> bool:
         return self.__authenticated
+
+    @property
+    def last_activity_time(self) -> float:
+        return self.__last_activity_time
+
+    @property
+    def peer_address(self) -> str:
+        return self.__peer_address
+
+    @property
+    def connect_time(self) -> float:
+        return self.__connect_time
+
+    @property
+    def requests_handled(self) -> int:
+        return self.__requests_handled
+
+    @property
+    def handling_time(self) -> float | None:
+        # how long the request being handled right now has taken so far, None if there is none
+        handle_start_time = self.__handle_start_time
+        if handle_start_time == None:
+            return None
+        return time.perf_counter() - handle_start_time
+
+    @property
+    def db_time_spent(self) -> float:
+        if self.__db_wrapper == None:
+            return 0.0
+        return self.__db_wrapper.time_spent
+
+    @property
+    def username(self) -> str | None:
+        return self.__username
@@ -1,8 +1,12 @@
 from shared.config import SERVER_CONFIG
+from shared.metrics import METRICS_REGISTRY
 from shared.items import Relation, Message
+from shared.tracing import TRACER
 
 import sqlite3
 import hashlib
+import logging
+import re
 import random
 import time
 import enum
@@ -18,6 +22,12 @@ class AddUserResult(enum.Enum):
 SQLITE3_TRUE = b"\xFF"
 SQLITE3_FALSE = b"\x00"
 
+# the statement and the table it is on, like "SELECT messages"
+STATEMENT_NAME_PATTERN = re.compile(
+    r"^\s*(\w+)\s+(?:.*?\b(?:FROM|INTO|TABLE|ON)\s+)?(?:IF\s+NOT\s+EXISTS\s+)?(\w+)",
+    re.DOTALL,
+)
+
 
 class DBWrapper:
     def __init__(self) -> None:
@@ -29,27 +39,99 @@ class DBWrapper:
             SERVER_CONFIG["database"]["connect_timeout"],
         )
         self.__cursor = self.__conn.cursor()
+        self.__logger = logging.getLogger("DBWrapper")
+        self.__time_spent = 0.0
 
     def __del__(self) -> None:
         self.__cursor.close()
         self.__conn.close()
 
+    def __execute(self, query: str, parameters: list | tuple = ()) -> None:
+        statement_name = self.__get_statement_name(query)
+        start_time = time.perf_counter()
+        try:
+            with TRACER.span(statement_name):
+                self.__cursor.execute(query, parameters)
+        finally:
+            elapsed_time = time.perf_counter() - start_time
+            self.__time_spent += elapsed_time
+            METRICS_REGISTRY.histogram(
+                "chat_db_statement_seconds",
+                "Time taken by database statements",
+                statement=statement_name,
+            ).observe(elapsed_time)
+            if elapsed_time > SERVER_CONFIG["slow_log"]["statement_threshold"]:
+                self.__logger.warning(
+                    "Slow statement (%.1f ms): %s %s",
+                    elapsed_time * 1000,
+                    " ".join(query.split()),
+                    self.__redact_parameters(parameters),
+                )
+
+    def __commit(self) -> None:
+        start_time = time.perf_counter()
+        with TRACER.span("COMMIT"):
+            self.__conn.commit()
+        elapsed_time = time.perf_counter() - start_time
+        self.__time_spent += elapsed_time
+        METRICS_REGISTRY.histogram(
+            "chat_db_commit_seconds", "Time taken by database commits"
+        ).observe(elapsed_time)
+        if elapsed_time > SERVER_CONFIG["slow_log"]["statement_threshold"]:
+            self.__logger.warning("Slow commit (%.1f ms)", elapsed_time * 1000)
+
+    @staticmethod
+    def __redact_parameters(parameters: list | tuple) -> list[str]:
+        # the parameters are messages, usernames and token hashes, only their shape is logged
+        return [
+            (
+                f"<{type(parameter).__name__} of {len(parameter)}>"
+                if isinstance(parameter, (str, bytes))
+                else f"<{type(parameter).__name__}>"
+            )
+            for parameter in parameters
+        ]
+
+    @staticmethod
+    def __get_statement_name(query: str) -> str:
+        statement_name = STATEMENT_NAME_PATTERN.match(query)
+        if statement_name == None:
+            return query.split(maxsplit=1)[0].upper()
+        return f"{statement_name[1].upper()} {statement_name[2]}"
+
+    @property
+    def time_spent(self) -> float:
+        # in seconds, in statements and commits since it was made
+        return self.__time_spent
+
+    def set_trace_callback(self, callback) -> None:
+        # called with every statement that is run, with its parameters filled in
+        self.__conn.set_trace_callback(callback)
+
     def ensure_tables(self) -> None:
-        self.__cursor.execute(
+        self.__execute(
             """CREATE TABLE IF NOT EXISTS users (
                 username TEXT NOT NULL,
                 token_hash BLOB NOT NULL
             )"""
         )
-        self.__cursor.execute(
+        self.__execute(
             """CREATE TABLE IF NOT EXISTS messages (
                 sender_username TEXT NOT NULL,
                 receiver_username TEXT NOT NULL,
                 content TEXT NOT NULL,
-                time_sent INTEGER NOT NULL
+                time_sent INTEGER NOT NULL,
+                idempotency_key BLOB
             )"""
         )
-        self.__cursor.execute(
+        # databases created before idempotency keys existed
+        self.__execute("SELECT name FROM pragma_table_info('messages')")
+        if ("idempotency_key",) not in self.__cursor.fetchall():
+            self.__execute("ALTER TABLE messages ADD COLUMN idempotency_key BLOB")
+        self.__execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS messages_idempotency_key ON messages (sender_username, idempotency_key)"
+        )
+        self.__execute(
             """CREATE TABLE IF NOT EXISTS relations (
                 first_user TEXT NOT NULL,
                 secondary_user TEXT NOT NULL,
@@ -60,7 +142,7 @@ class DBWrapper:
         )
 
     def get_relation(self, first_username: str, secondary_username: str) -> Relation:
-        self.__cursor.execute(
+        self.__execute(
             "SELECT * FROM relations WHERE first_user == ? AND secondary_user == ?",
             [first_username, secondary_username],
         )
@@ -68,7 +150,7 @@ class DBWrapper:
         return Relation(*relation)
 
     def get_all_relations(self, first_username: str) -> list[Relation]:
-        self.__cursor.execute(
+        self.__execute(
             "SELECT * FROM relations WHERE first_user == ?", [first_username]
         )
         relations = self.__cursor.fetchall()
@@ -85,35 +167,36 @@ class DBWrapper:
         ]
 
     def get_messages(
-        self, first_user: str, second_user: str, time_back_secs: int
+        self, first_user: str, second_user: str, after_id: int
     ) -> list[Message]:
-        self.__cursor.execute(
-            "SELECT sender_username, content, time_sent FROM messages WHERE sender_username IN (?, ?) AND receiver_username IN (?, ?) AND time_sent >= ?",
+        self.__execute(
+            "SELECT rowid, sender_username, receiver_username, content, time_sent FROM messages WHERE ((sender_username == ? AND receiver_username == ?) OR (sender_username == ? AND receiver_username == ?)) AND rowid > ? ORDER BY rowid",
             [
                 first_user,
                 second_user,
-                first_user,
                 second_user,
-                int(time.time() - time_back_secs),
+                first_user,
+                after_id,
             ],
         )
 
         messages = [
-            Message(
+            Message(message_id, sender, receiver, time_sent, content)
+            for (
+                message_id,
                 sender,
-                first_user if sender == second_user else first_user,
-                time_sent,
+                receiver,
                 content,
-            )
-            for sender, content, time_sent in self.__cursor.fetchall()
+                time_sent,
+            ) in self.__cursor.fetchall()
         ]
 
         return messages
 
     def add_user(self, username: str) -> tuple[str | None, AddUserResult]:
-        if username < SERVER_CONFIG["database"]["min_username_length"]:
+        if len(username) < SERVER_CONFIG["database"]["min_username_length"]:
             return None, AddUserResult.username_too_short
-        if username > SERVER_CONFIG["database"]["max_username_length"]:
+        if len(username) > SERVER_CONFIG["database"]["max_username_length"]:
             return None, AddUserResult.username_too_long
 
         token = "".join(
@@ -124,132 +207,115 @@ class DBWrapper:
         )
         token_hash = hashlib.sha512(token.encode()).digest()
 
-        self.__cursor.execute(
+        self.__execute(
             "INSERT INTO users (username, token_hash) VALUES (?, ?)",
             [username, token_hash],
         )
 
-        self.__conn.commit()
+        self.__commit()
         return token, AddUserResult.success
 
     def add_friend(self, first_user: str, secondary_user: str) -> bool:
-        if first_user == secondary_user:
-            return False
-        if not self.check_user_exists(secondary_user):
+        if not self.__set_friend(first_user, secondary_user, True):
             return False
 
-        self.__cursor.execute(
-            "SELECT first_is_friend FROM relations WHERE first_user == ? AND secondary_user == ?",
-            [first_user, secondary_user],
-        )
-        first_is_friend = self.__cursor.fetchone()
-
-        self.__cursor.execute(
-            "SELECT first_is_friend FROM relations WHERE first_user == ? AND secondary_user == ?",
-            [secondary_user, first_user],
-        )
-        secondary_is_friend = self.__cursor.fetchone() != None
+        self.__commit()
+        return True
 
-        if first_is_friend == None:
-            self.__cursor.execute(
-                "INSERT INTO relations (first_user, secondary_user, first_is_friend, secondary_is_friend, secondary_is_blocked) VALUES (?, ?, ?, ?, ?)",
-                [
-                    first_user,
-                    secondary_user,
-                    SQLITE3_TRUE,
-                    SQLITE3_FALSE,
-                    SQLITE3_FALSE,
-                ],
-            )
-        else:
-            self.__cursor.execute(
-                "UPDATE relations SET first_is_friend = ? WHERE first_user == ? AND secondary_user == ?",
-                [SQLITE3_TRUE, first_user, secondary_user],
-            )
-        if secondary_is_friend == None:
-            self.__cursor.execute(
-                "INSERT INTO relations (first_user, secondary_user, first_is_friend, secondary_is_friend, secondary_is_blocked) VALUES (?, ?, ?, ?, ?)",
-                [
-                    secondary_user,
-                    first_user,
-                    SQLITE3_FALSE,
-                    SQLITE3_TRUE,
-                    SQLITE3_FALSE,
-                ],
-            )
-        else:
-            self.__cursor.execute(
-                "UPDATE relations SET secondary_is_friend = ? WHERE first_user == ? AND secondary_user == ?",
-                [SQLITE3_TRUE, secondary_user, first_user],
-            )
+    def remove_friend(self, first_user: str, secondary_user: str) -> bool:
+        if not self.__set_friend(first_user, secondary_user, False):
+            return False
 
-        self.__conn.commit()
+        self.__commit()
         return True
 
-    def remove_friend(self, first_user: str, secondary_user: str) -> bool:
+    def update_friends(
+        self, first_user: str, secondary_users: list[str], is_friend: bool
+    ) -> list[bool]:
+        # all of them are committed together, or none of them if something goes wrong
+        try:
+            results = [
+                self.__set_friend(first_user, secondary_user, is_friend)
+                for secondary_user in secondary_users
+            ]
+        except sqlite3.Error:
+            self.__conn.rollback()
+            raise
+
+        self.__commit()
+        return results
+
+    def __set_friend(
+        self, first_user: str, secondary_user: str, is_friend: bool
+    ) -> bool:
         if first_user == secondary_user:
             return False
         if not self.check_user_exists(secondary_user):
             return False
 
-        self.__cursor.execute(
+        self.__execute(
             "SELECT first_is_friend FROM relations WHERE first_user == ? AND secondary_user == ?",
             [first_user, secondary_user],
         )
         first_is_friend = self.__cursor.fetchone()
 
-        self.__cursor.execute(
+        self.__execute(
             "SELECT first_is_friend FROM relations WHERE first_user == ? AND secondary_user == ?",
             [secondary_user, first_user],
         )
-        secondary_is_friend = self.__cursor.fetchone() != None
+        secondary_is_friend = self.__cursor.fetchone()
 
         if first_is_friend == None:
-            self.__cursor.execute(
+            self.__execute(
                 "INSERT INTO relations (first_user, secondary_user, first_is_friend, secondary_is_friend, secondary_is_blocked) VALUES (?, ?, ?, ?, ?)",
                 [
                     first_user,
                     secondary_user,
-                    SQLITE3_FALSE,
+                    SQLITE3_TRUE if is_friend else SQLITE3_FALSE,
                     SQLITE3_FALSE,
                     SQLITE3_FALSE,
                 ],
             )
         else:
-            self.__cursor.execute(
+            self.__execute(
                 "UPDATE relations SET first_is_friend = ? WHERE first_user == ? AND secondary_user == ?",
-                [SQLITE3_FALSE, first_user, secondary_user],
+                [
+                    SQLITE3_TRUE if is_friend else SQLITE3_FALSE,
+                    first_user,
+                    secondary_user,
+                ],
             )
         if secondary_is_friend == None:
-            self.__cursor.execute(
+            self.__execute(
                 "INSERT INTO relations (first_user, secondary_user, first_is_friend, secondary_is_friend, secondary_is_blocked) VALUES (?, ?, ?, ?, ?)",
                 [
                     secondary_user,
                     first_user,
                     SQLITE3_FALSE,
-                    SQLITE3_FALSE,
+                    SQLITE3_TRUE if is_friend else SQLITE3_FALSE,
                     SQLITE3_FALSE,
                 ],
             )
         else:
-            self.__cursor.execute(
+            self.__execute(
                 "UPDATE relations SET secondary_is_friend = ? WHERE first_user == ? AND secondary_user == ?",
-                [SQLITE3_FALSE, secondary_user, first_user],
+                [
+                    SQLITE3_TRUE if is_friend else SQLITE3_FALSE,
+                    secondary_user,
+                    first_user,
+                ],
             )
 
-        self.__conn.commit()
         return True
 
     def check_user_exists(self, username: str) -> bool:
-        self.__cursor.execute(
-            "SELECT username FROM users WHERE username == ?", [username]
-        )
+        self.__execute("SELECT username FROM users WHERE username == ?", [username])
         username = self.__cursor.fetchone()
 
         return username != None
 
     def check_token(self, token: str) -> tuple[bool, str | None]:
-        self.__cursor.execute(
+        self.__execute(
             "SELECT username FROM users WHERE token_hash == ?",
             [hashlib.sha512(token.encode()).digest()],
         )
@@ -260,10 +326,27 @@ class DBWrapper:
 
         return True, usernames[0]
 
-    def add_message(self, sender: str, receiver: str, content: str) -> None:
-        self.__cursor.execute(
-            "INSERT INTO messages (sender_username, receiver_username, content, time_sent) VALUES (?, ?, ?, ?)",
-            [sender, receiver, content, int(time.time())],
-        )
+    def add_message(
+        self, sender: str, receiver: str, content: str, idempotency_key: bytes
+    ) -> tuple[Message, bool]:
+        time_sent = int(time.time())
+        try:
+            self.__execute(
+                "INSERT INTO messages (sender_username, receiver_username, content, time_sent, idempotency_key) VALUES (?, ?, ?, ?, ?)",
+                [sender, receiver, content, time_sent, idempotency_key],
+            )
+        except sqlite3.IntegrityError:
+            # retried message, return the one that was already added. the failed insert
+            # left a transaction open, which would keep every other session from writing
+            self.__conn.rollback()
+            self.__execute(
+                "SELECT rowid, sender_username, receiver_username, time_sent, content FROM messages WHERE sender_username == ? AND idempotency_key == ?",
+                [sender, idempotency_key],
+            )
+            return Message(*self.__cursor.fetchone()), False
 
-        self.__conn.commit()
+        self.__commit()
+        return (
+            Message(self.__cursor.lastrowid, sender, receiver, time_sent, content),  # type: ignore
+            True,
+        )
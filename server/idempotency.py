@@ -0,0 +1,46 @@
+import collections
+import threading
+
+
+class RecentIdempotencyKeys:
+    def __init__(self, max_size: int) -> None:
+        self.__max_size = max_size
+        self.__keys: collections.OrderedDict[tuple[str, bytes], int] = (
+            collections.OrderedDict()
+        )
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+    def get(self, sender: str, idempotency_key: bytes) -> int | None:
+        with self.__lock:
+            message_id = self.__keys.get((sender, idempotency_key))
+            if message_id != None:
+                self.__keys.move_to_end((sender, idempotency_key))
+                self.__hits += 1
+            else:
+                self.__misses += 1
+            return message_id
+
+    def add(self, sender: str, idempotency_key: bytes, message_id: int) -> None:
+        with self.__lock:
+            self.__keys[(sender, idempotency_key)] = message_id
+            self.__keys.move_to_end((sender, idempotency_key))
+            while len(self.__keys) > self.__max_size:
+                self.__keys.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.__keys)
+
+    @property
+    def max_size(self) -> int:
+        return self.__max_size
+
+    @property
+    def hits(self) -> int:
+        # retries of messages that were still remembered
+        return self.__hits
+
+    @property
+    def misses(self) -> int:
+        return self.__misses
@@ -0,0 +1,87 @@
+import collections
+import threading
+import logging
+import time
+import sys
+import os
+
+
+class SamplingProfiler:
+    # looks at what every thread is doing a number of times a second, nothing runs
+    # (and nothing is slowed down) while it isn't profiling
+    def __init__(self) -> None:
+        self.__logger = logging.getLogger("SamplingProfiler")
+        self.__thread = None
+        self.__lock = threading.Lock()
+        self.__output_path = None
+
+    def start(self, duration: float, rate: float, output_path: str) -> bool:
+        # returns False if it's already profiling
+        with self.__lock:
+            if self.running:
+                return False
+            self.__output_path = output_path
+            self.__thread = threading.Thread(
+                target=self.__profile,
+                args=[duration, rate, output_path],
+                name="SamplingProfiler",
+                daemon=True,
+            )
+            self.__thread.start()
+            return True
+
+    @property
+    def running(self) -> bool:
+        return self.__thread != None and self.__thread.is_alive()
+
+    @property
+    def output_path(self) -> str | None:
+        # of the last profile
+        return self.__output_path
+
+    def __profile(self, duration: float, rate: float, output_path: str) -> None:
+        self.__logger.info(
+            "Profiling for %s seconds at %s samples a second", duration, rate
+        )
+        # stack (root first, separated by ;) -> how many samples it was in
+        stack_counts = collections.Counter()
+        own_thread_id = threading.get_ident()
+        end_time = time.perf_counter() + duration
+        next_sample_time = time.perf_counter()
+        samples = 0
+        while next_sample_time < end_time:
+            thread_names = {
+                thread.ident: thread.name for thread in threading.enumerate()
+            }
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                stack_counts[
+                    self.__collapse_stack(
+                        thread_names.get(thread_id, str(thread_id)), frame
+                    )
+                ] += 1
+            samples += 1
+
+            # on a schedule, so slow samples don't lower the rate
+            next_sample_time += 1 / rate
+            time.sleep(max(next_sample_time - time.perf_counter(), 0))
+
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        with open(output_path, "w") as file:
+            for stack, count in stack_counts.most_common():
+                file.write(f"{stack} {count}\n")
+        self.__logger.info("Wrote %s samples to %s", samples, output_path)
+
+    @staticmethod
+    def __collapse_stack(thread_name: str, frame) -> str:
+        # the format flamegraph tools take, the thread is the root so each has its own tower
+        functions = []
+        while frame != None:
+            code = frame.f_code
+            functions.append(
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            )
+            frame = frame.f_back
+        functions.append(thread_name.replace(";", ","))
+        return ";".join(reversed(functions))
@@ -0,0 +1,38 @@
+import hashlib
+import hmac
+import time
+import os
+
+
+# ticket layout: expiry time (8 bytes) + username + hmac-sha256 of both (32 bytes)
+TICKET_EXPIRY_BYTES = 8
+TICKET_MAC_BYTES = hashlib.sha256().digest_size
+
+
+class ResumeTicketSigner:
+    def __init__(self, secret: str, lifetime: float) -> None:
+        self.__secret = secret.encode() if len(secret) > 0 else os.urandom(32)
+        self.__lifetime = lifetime
+
+    def issue(self, username: str) -> bytes:
+        ticket_data = int(time.time() + self.__lifetime).to_bytes(TICKET_EXPIRY_BYTES)
+        ticket_data += username.encode()
+
+        return ticket_data + self.__sign(ticket_data)
+
+    def verify(self, ticket: bytes) -> str | None:
+        if len(ticket) <= TICKET_EXPIRY_BYTES + TICKET_MAC_BYTES:
+            return None
+
+        ticket_data = ticket[:-TICKET_MAC_BYTES]
+        if not hmac.compare_digest(
+            self.__sign(ticket_data), ticket[-TICKET_MAC_BYTES:]
+        ):
+            return None
+        if int.from_bytes(ticket_data[:TICKET_EXPIRY_BYTES]) < time.time():
+            return None
+
+        return ticket_data[TICKET_EXPIRY_BYTES:].decode()
+
+    def __sign(self, ticket_data: bytes) -> bytes:
+        return hmac.new(self.__secret, ticket_data, hashlib.sha256).digest()
@@ -0,0 +1,48 @@
+from typing import Generic, TypeVar
+
+import threading
+import math
+
+
+T = TypeVar("T")
+
+
+class TimingWheel(Generic[T]):
+    def __init__(self, tick_duration: float, slot_count: int) -> None:
+        self.__tick_duration = tick_duration
+        # every slot holds [item, rounds left] pairs, an item expires when its
+        # slot comes around with no rounds left
+        self.__slots: list[list[list]] = [[] for _ in range(slot_count)]
+        self.__current_slot = 0
+        self.__lock = threading.Lock()
+
+    def schedule(self, item: T, delay: float) -> None:
+        ticks = max(1, math.ceil(delay / self.__tick_duration))
+        with self.__lock:
+            slot = (self.__current_slot + ticks) % len(self.__slots)
+            self.__slots[slot].append([item, (ticks - 1) // len(self.__slots)])
+
+    def tick(self) -> list[T]:
+        with self.__lock:
+            self.__current_slot = (self.__current_slot + 1) % len(self.__slots)
+            entries = self.__slots[self.__current_slot]
+
+            expired_items = []
+            remaining_entries = []
+            for entry in entries:
+                if entry[1] == 0:
+                    expired_items.append(entry[0])
+                else:
+                    entry[1] -= 1
+                    remaining_entries.append(entry)
+            self.__slots[self.__current_slot] = remaining_entries
+
+        return expired_items
+
+    @property
+    def tick_duration(self) -> float:
+        return self.__tick_duration
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return sum(len(slot) for slot in self.__slots)
@@ -55,12 +55,46 @@ SERVER_CONFIG_STRUCTURE = {
         "token_charset": str,
         "min_username_length": int,
         "max_username_length": int,
+        "idempotency_cache_size": int,
     },
     "connection": {
         "listen_address": str,
         "listen_port": int,
         "authentication_timeout": float | int,
         "accept_backlog": int,
+        "idle_timeout": float | int,
+        "idle_check_interval": float | int,
+        "resume_ticket_lifetime": float | int,
+        "resume_ticket_secret": str,
+    },
+    "slow_log": {
+        "statement_threshold": float | int,
+        "request_threshold": float | int,
+    },
+    "metrics": {
+        "enabled": bool,
+        "listen_address": str,
+        "listen_port": int,
+    },
+    "logging": {
+        "level": str,
+    },
+    "tracing": {
+        "enabled": bool,
+        "filepath": str,
+    },
+    "admin": {
+        "enabled": bool,
+        "listen_address": str,
+        "listen_port": int,
+        "token": str,
+    },
+    "profiler": {
+        "output_directory": str,
+        "default_rate": float | int,
+        "max_rate": float | int,
+        "default_duration": float | int,
+        "max_duration": float | int,
     },
 }
 
@@ -69,6 +103,8 @@ SHARED_CONFIG_STRUCTURE = {
         "packet_type_bytes": int,
         "packet_id_bytes": int,
         "packet_data_length_bytes": int,
+        "idempotency_key_bytes": int,
+        "frame_timeout": float | int,
     },
 }
 
@@ -77,6 +113,10 @@ CLIENT_CONFIG_STRUCTURE = {
         "connect_address": str,
         "connect_port": int,
         "authentication_timeout": float | int,
+        "reconnect_initial_delay": float | int,
+        "reconnect_max_delay": float | int,
+        "heartbeat_interval": float | int,
+        "heartbeat_timeout": float | int,
     },
     "user": {
         "token": str,
@@ -84,9 +124,36 @@ CLIENT_CONFIG_STRUCTURE = {
     "gui": {
         "host_address": str,
         "host_port": int,
+        "live_updates": str,
+        "sse_keepalive_interval": float | int,
+        "page_deadline": float | int,
+        "messages_page_size": int,
+        "max_rendered_messages": int,
+        "rendered_messages_cache_size": int,
+        "server": str,
+        "worker_threads": int,
+        "max_queued_connections": int,
+        "max_connections": int,
+        "keep_alive_timeout": float | int,
     },
     "events": {
         "event_id_bytes": int,
+        "request_timeout": float | int,
+        "max_unclaimed_responses": int,
+        "max_cached_messages": int,
+    },
+    "metrics": {
+        "enabled": bool,
+        "listen_address": str,
+        "listen_port": int,
+    },
+    "logging": {
+        "level": str,
+    },
+    "tracing": {
+        "enabled": bool,
+        "filepath": str,
+        "sample_rate": float | int,
     },
 }
 
@@ -12,6 +12,7 @@ class Relation:
 
 @dataclasses.dataclass(frozen=True)
 class Message:
+    id: int
     sender: str
     receiver: str
     time_sent: int
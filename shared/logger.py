@@ -1,5 +1,8 @@
+import logging.handlers
 import colorama
 import logging
+import atexit
+import queue
 
 
 class ColoredFormatter(logging.Formatter):
@@ -14,27 +17,66 @@ class ColoredFormatter(logging.Formatter):
     }
 
     def format(self, record: logging.LogRecord):
+        # records from a ConnectionLoggerAdapter say which connection they're about
+        connection = getattr(record, "connection", None)
+        record.source = (
+            record.name if connection == None else f"{record.name} ({connection})"
+        )
         log_color = self.COLORS.get(record.levelno, "")
         formatted_message = super().format(record)
         return log_color + formatted_message + colorama.Style.RESET_ALL
 
 
+class ConnectionLoggerAdapter(logging.LoggerAdapter):
+    # one logger for all connections, with the connection in the records instead of
+    # the name, because loggers are never freed and there's a new connection all the time
+    def __init__(self, logger: logging.Logger, connection: str) -> None:
+        super().__init__(logger, {"connection": connection})
+
+    def process(self, msg, kwargs):
+        kwargs["extra"] = {**self.extra, **kwargs.get("extra", {})}  # type: ignore
+        return msg, kwargs
+
+
 _colorama_initialized = False
+_queue_listener = None
+
 
+def _stop_queue_listener() -> None:
+    global _queue_listener
 
-def configure_logger(level: int) -> None:
-    global _colorama_initialized
+    # writes out whatever is still queued
+    if _queue_listener != None:
+        _queue_listener.stop()
+        _queue_listener = None
+
+
+def configure_logger(level: int | str) -> None:
+    global _colorama_initialized, _queue_listener
 
     if not _colorama_initialized:
         colorama.init(autoreset=True)
+        atexit.register(_stop_queue_listener)
         _colorama_initialized = True
 
     console_handler = logging.StreamHandler()
     console_handler.setLevel(level)
     console_formatter = ColoredFormatter(
-        "%(asctime)s.%(msecs)03d - %(name)s - %(levelname)s - %(message)s",
+        "%(asctime)s.%(msecs)03d - %(source)s - %(levelname)s - %(message)s",
         datefmt="%H:%M:%S",
     )
     console_handler.setFormatter(console_formatter)
 
-    logging.basicConfig(level=level, handlers=[console_handler])
+    # the threads logging only put records in a queue, and a background thread
+    # writes them out, so a slow console doesn't slow down handling packets
+    _stop_queue_listener()
+    log_queue = queue.SimpleQueue()
+    _queue_listener = logging.handlers.QueueListener(
+        log_queue, console_handler, respect_handler_level=True
+    )
+    _queue_listener.start()
+
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # only merges the arguments into the message, the console handler does the rest
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    logging.basicConfig(level=level, handlers=[queue_handler], force=True)
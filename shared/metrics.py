@@ -0,0 +1,217 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import threading
+import logging
+import math
+
+
+def _format_series(name: str, labels: str) -> str:
+    return f"{name}{{{labels}}}" if len(labels) > 0 else name
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.__value = 0
+        self.__lock = threading.Lock()
+
+    def inc(self, amount: int | float = 1) -> None:
+        with self.__lock:
+            self.__value += amount
+
+    def render(self, name: str, labels: str) -> list[str]:
+        return [f"{_format_series(name, labels)} {self.__value}"]
+
+
+class Gauge:
+    def __init__(self) -> None:
+        self.__value = 0
+        self.__lock = threading.Lock()
+
+    def set(self, value: int | float) -> None:
+        with self.__lock:
+            self.__value = value
+
+    def inc(self, amount: int | float = 1) -> None:
+        with self.__lock:
+            self.__value += amount
+
+    def dec(self, amount: int | float = 1) -> None:
+        self.inc(-amount)
+
+    def render(self, name: str, labels: str) -> list[str]:
+        return [f"{_format_series(name, labels)} {self.__value}"]
+
+
+class Histogram:
+    # hdr style buckets, every power of two is split into a few linear ones, so the
+    # error is the same relative amount for a microsecond as it is for ten seconds
+    MIN_EXPONENT = -20  # about a microsecond
+    MAX_EXPONENT = 7  # 128 seconds
+    SUB_BUCKETS = 4
+
+    def __init__(self) -> None:
+        self.__counts = [0] * (
+            (self.MAX_EXPONENT - self.MIN_EXPONENT) * self.SUB_BUCKETS
+        )
+        self.__overflow_count = 0
+        self.__sum = 0.0
+        self.__lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = self.__get_bucket_index(value)
+        with self.__lock:
+            if index < len(self.__counts):
+                self.__counts[index] += 1
+            else:
+                self.__overflow_count += 1
+            self.__sum += value
+
+    def render(self, name: str, labels: str) -> list[str]:
+        with self.__lock:
+            counts = list(self.__counts)
+            overflow_count = self.__overflow_count
+            value_sum = self.__sum
+
+        # only the buckets with something in them, and the bound right under each of
+        # them, so the quantiles can still be told apart
+        separator = "," if len(labels) > 0 else ""
+        lines = []
+        cumulative_count = 0
+        for index, count in enumerate(counts):
+            if index + 1 < len(counts) and counts[index + 1] > 0 and count == 0:
+                lines.append(
+                    f'{name}_bucket{{{labels}{separator}le="{self.__get_bucket_bound(index):.9g}"}} {cumulative_count}'
+                )
+            if count == 0:
+                continue
+            cumulative_count += count
+            lines.append(
+                f'{name}_bucket{{{labels}{separator}le="{self.__get_bucket_bound(index):.9g}"}} {cumulative_count}'
+            )
+        cumulative_count += overflow_count
+        lines.append(
+            f'{name}_bucket{{{labels}{separator}le="+Inf"}} {cumulative_count}'
+        )
+        lines.append(f"{_format_series(name + '_sum', labels)} {value_sum}")
+        lines.append(f"{_format_series(name + '_count', labels)} {cumulative_count}")
+        return lines
+
+    def __get_bucket_index(self, value: float) -> int:
+        if value <= 2.0**self.MIN_EXPONENT:
+            return 0
+
+        # value = mantissa * 2 ** exponent, with the mantissa in [0.5, 1)
+        mantissa, exponent = math.frexp(value)
+        sub_bucket = min(
+            int((mantissa * 2 - 1) * self.SUB_BUCKETS), self.SUB_BUCKETS - 1
+        )
+        return (exponent - 1 - self.MIN_EXPONENT) * self.SUB_BUCKETS + sub_bucket
+
+    def __get_bucket_bound(self, index: int) -> float:
+        exponent, sub_bucket = divmod(index, self.SUB_BUCKETS)
+        return 2.0 ** (exponent + self.MIN_EXPONENT) * (
+            1 + (sub_bucket + 1) / self.SUB_BUCKETS
+        )
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        # name -> (type, help text, labels -> metric)
+        self.__families: dict[
+            str,
+            tuple[
+                str, str, dict[tuple[tuple[str, str], ...], Counter | Gauge | Histogram]
+            ],
+        ] = {}
+        self.__lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str, **labels: str) -> Counter:
+        return self.__get_metric(Counter, "counter", name, help_text, labels)  # type: ignore
+
+    def gauge(self, name: str, help_text: str, **labels: str) -> Gauge:
+        return self.__get_metric(Gauge, "gauge", name, help_text, labels)  # type: ignore
+
+    def histogram(self, name: str, help_text: str, **labels: str) -> Histogram:
+        return self.__get_metric(Histogram, "histogram", name, help_text, labels)  # type: ignore
+
+    def render(self) -> str:
+        # the prometheus text format
+        with self.__lock:
+            families = [
+                (name, metric_type, help_text, list(metrics.items()))
+                for name, (metric_type, help_text, metrics) in self.__families.items()
+            ]
+
+        lines = []
+        for name, metric_type, help_text, metrics in sorted(families):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, metric in metrics:
+                lines += metric.render(
+                    name,
+                    ",".join(
+                        [f'{key}="{self.__escape(value)}"' for key, value in labels]
+                    ),
+                )
+
+        return "\n".join(lines) + "\n"
+
+    def __get_metric(
+        self,
+        metric_class: type,
+        metric_type: str,
+        name: str,
+        help_text: str,
+        labels: dict[str, str],
+    ) -> Counter | Gauge | Histogram:
+        label_items = tuple(sorted(labels.items()))
+        with self.__lock:
+            family = self.__families.setdefault(name, (metric_type, help_text, {}))
+            if family[0] != metric_type:
+                raise TypeError(f"metric '{name}' is already a {family[0]}")
+
+            metric = family[2].get(label_items)
+            if metric == None:
+                metric = metric_class()
+                family[2][label_items] = metric
+            return metric
+
+    @staticmethod
+    def __escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# shared by everything in the process, so any part can record into it
+METRICS_REGISTRY = MetricsRegistry()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = METRICS_REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        # every request is logged, don't format it for nothing
+        logger = logging.getLogger("MetricsServer")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def start_metrics_server(address: str, port: int) -> ThreadingHTTPServer:
+    metrics_server = ThreadingHTTPServer((address, port), _MetricsRequestHandler)
+    metrics_server.daemon_threads = True
+    threading.Thread(
+        target=metrics_server.serve_forever, name="MetricsServer", daemon=True
+    ).start()
+    logging.getLogger("MetricsServer").info(
+        "Serving metrics on http://%s:%s/metrics", *metrics_server.server_address[:2]
+    )
+    return metrics_server
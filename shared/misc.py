@@ -1,3 +1,4 @@
+import itertools
 import enum
 
 
@@ -15,3 +16,13 @@ class UniqueValueEnumMeta(enum.EnumMeta):
 
 
 class UniqueValueEnum(enum.Enum, metaclass=UniqueValueEnumMeta): ...
+
+
+class SequentialIdAllocator:
+    def __init__(self, id_bytes: int) -> None:
+        self.__id_limit = 2 ** (id_bytes * 8)
+        self.__counter = itertools.count()
+
+    def next_id(self) -> int:
+        # next() on itertools.count is atomic, so this is thread safe
+        return next(self.__counter) % self.__id_limit
@@ -1,15 +1,38 @@
 from .packets import (
     PACKET_TYPE_TO_CLASS,
+    TRACE_CONTEXT_FLAG,
     PacketType,
     Packet,
 )
+from .logger import ConnectionLoggerAdapter
+from .misc import SequentialIdAllocator
+from .tracing import TRACE_CONTEXT_BYTES, TraceContext
+from .metrics import METRICS_REGISTRY
 from .config import SHARED_CONFIG
 
+import threading
 import logging
+import select
 import socket
+import time
 import os
 
 
+def _count_packet(direction: str, packet_type: PacketType, length: int) -> None:
+    METRICS_REGISTRY.counter(
+        "chat_packets_total",
+        "Packets sent and received",
+        direction=direction,
+        packet_type=packet_type.name,
+    ).inc()
+    METRICS_REGISTRY.counter(
+        "chat_packet_bytes_total",
+        "Bytes of packets sent and received, headers included",
+        direction=direction,
+        packet_type=packet_type.name,
+    ).inc(length)
+
+
 class RaisingSocket(socket.socket):
     def recv(self, bufsize: int, flags: int = 0) -> bytes:
         data = super().recv(bufsize, flags)
@@ -31,45 +54,135 @@ class RaisingSocket(socket.socket):
 class PacketSocket:
     def __init__(self, sock: socket.socket) -> None:
         self.__raising_sock = RaisingSocket.from_existing_socket(sock)
-        self.__logger = logging.getLogger(
-            f"PacketSocket ({sock.getpeername()[0]}:{sock.getpeername()[1]})"
+        # packets are small and a response can follow a push right away, nagle's
+        # algorithm would hold it back until the push is acked
+        self.__raising_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.__logger = ConnectionLoggerAdapter(
+            logging.getLogger("PacketSocket"),
+            f"{sock.getpeername()[0]}:{sock.getpeername()[1]}",
+        )
+        self.__packet_id_allocator = SequentialIdAllocator(
+            SHARED_CONFIG["packets"]["packet_id_bytes"]
         )
+        # packets can be sent from other threads (pushes), they mustn't interleave
+        self.__send_lock = threading.Lock()
+        self.__packets_sent = 0
+        self.__packets_received = 0
+        self.__bytes_sent = 0
+        self.__bytes_received = 0
 
     def recv(self) -> Packet:
+        header = self.__recv_exactly(
+            SHARED_CONFIG["packets"]["packet_id_bytes"]
+            + SHARED_CONFIG["packets"]["packet_type_bytes"]
+            + SHARED_CONFIG["packets"]["packet_data_length_bytes"],
+            frame_started=False,
+        )
+        # the header is sliced up below, but it all counts
+        header_length = len(header)
         packet_id = int.from_bytes(
-            self.__raising_sock.recv(SHARED_CONFIG["packets"]["packet_id_bytes"])
+            header[: SHARED_CONFIG["packets"]["packet_id_bytes"]]
         )
-        packet_type = PacketType(
-            int.from_bytes(
-                self.__raising_sock.recv(SHARED_CONFIG["packets"]["packet_type_bytes"])
-            )
+        header = header[SHARED_CONFIG["packets"]["packet_id_bytes"] :]
+        packet_type_value = int.from_bytes(
+            header[: SHARED_CONFIG["packets"]["packet_type_bytes"]]
         )
-        packet_data_length = int.from_bytes(
-            self.__raising_sock.recv(
-                SHARED_CONFIG["packets"]["packet_data_length_bytes"]
+        packet_type = PacketType(packet_type_value & ~TRACE_CONTEXT_FLAG)
+        header = header[SHARED_CONFIG["packets"]["packet_type_bytes"] :]
+        packet_data_length = int.from_bytes(header)
+        trace_context_data = b""
+        if packet_type_value & TRACE_CONTEXT_FLAG:
+            trace_context_data = self.__recv_exactly(
+                TRACE_CONTEXT_BYTES, frame_started=True
             )
-        )
-        packet_data = self.__raising_sock.recv(packet_data_length)
+        packet_data = self.__recv_exactly(packet_data_length, frame_started=True)
 
         packet = PACKET_TYPE_TO_CLASS[packet_type](packet_id)
         packet.init_packet_from_data(packet_data)
-        self.__logger.debug(
-            "Received packet (type: %s, id: %s, data_length: %s bytes)",
-            packet.type.name,
-            packet.id,
-            packet.data_length,
-        )
+        if len(trace_context_data) > 0:
+            packet.trace_context = TraceContext.from_bytes(trace_context_data)
+        packet_length = header_length + len(trace_context_data) + len(packet_data)
+        _count_packet("received", packet_type, packet_length)
+        self.__packets_received += 1
+        self.__bytes_received += packet_length
+        # every packet goes through here, so don't even make the record if it's not shown
+        if self.__logger.isEnabledFor(logging.DEBUG):
+            self.__logger.debug(
+                "Received packet (type: %s, id: %s, data_length: %s bytes)",
+                packet.type.name,
+                packet.id,
+                packet.data_length,
+            )
         return packet
 
     def send(self, packet: Packet) -> None:
-        self.__logger.debug(
-            "Sending packet (type: %s, id: %s, data_length: %s bytes)",
-            packet.type.name,
-            packet.id,
-            packet.data_length,
-        )
-        self.__raising_sock.sendall(packet.compile())
+        if packet.id == None:
+            packet.id = self.__packet_id_allocator.next_id()
+
+        if self.__logger.isEnabledFor(logging.DEBUG):
+            self.__logger.debug(
+                "Sending packet (type: %s, id: %s, data_length: %s bytes)",
+                packet.type.name,
+                packet.id,
+                packet.data_length,
+            )
+
+        # the socket is non blocking, so wait for room in the send buffer instead of raising
+        data_to_send = packet.compile()
+        data = memoryview(data_to_send)
+        with self.__send_lock:
+            max_send_time = time.time() + SHARED_CONFIG["packets"]["frame_timeout"]
+            while len(data) > 0:
+                try:
+                    data = data[self.__raising_sock.send(data) :]
+                except BlockingIOError:
+                    self.__wait_for_socket(max_send_time, for_writing=True)
+            self.__packets_sent += 1
+            self.__bytes_sent += len(data_to_send)
+        _count_packet("sent", packet.type, len(data_to_send))
+
+    def __recv_exactly(self, length: int, frame_started: bool) -> bytes:
+        data = bytearray()
+        max_recv_time = time.time() + SHARED_CONFIG["packets"]["frame_timeout"]
+        while len(data) < length:
+            try:
+                data += self.__raising_sock.recv(length - len(data))
+            except BlockingIOError:
+                # nothing to read yet, let the caller decide when to try again
+                if not frame_started and len(data) == 0:
+                    raise
+                # the rest of a half received packet should be on its way
+                self.__wait_for_socket(max_recv_time, for_writing=False)
+
+        return bytes(data)
+
+    def __wait_for_socket(self, max_wait_time: float, for_writing: bool) -> None:
+        remaining_time = max_wait_time - time.time()
+        if remaining_time <= 0:
+            raise TimeoutError("Timed out in the middle of a packet")
+
+        if for_writing:
+            select.select([], [self.__raising_sock], [], remaining_time)
+        else:
+            select.select([self.__raising_sock], [], [], remaining_time)
 
     @property
     def raising_socket(self) -> socket.socket:
         return self.__raising_sock
+
+    @property
+    def packets_sent(self) -> int:
+        return self.__packets_sent
+
+    @property
+    def packets_received(self) -> int:
+        return self.__packets_received
+
+    @property
+    def bytes_sent(self) -> int:
+        # headers included
+        return self.__bytes_sent
+
+    @property
+    def bytes_received(self) -> int:
+        return self.__bytes_received
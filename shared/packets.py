@@ -1,11 +1,15 @@
 from .items import Relation, Message
+from .tracing import TraceContext
 from .config import SHARED_CONFIG
 from .misc import UniqueValueEnum
 
-import random
 import abc
 
 
+# the highest bit of the packet type says a trace context comes right after the header
+TRACE_CONTEXT_FLAG = 1 << (SHARED_CONFIG["packets"]["packet_type_bytes"] * 8 - 1)
+
+
 class PacketType(UniqueValueEnum):
     client_authenticate = 100
     client_get_relations = 101
@@ -13,9 +17,13 @@ class PacketType(UniqueValueEnum):
     client_add_friend = 103
     client_remove_friend = 104
     client_send_message = 105
+    client_resume_session = 106
+    client_update_friends = 107
 
     quit = 200
     invalid_packet_type = 201
+    ping = 202
+    pong = 203
 
     server_authenticate = 300
     server_get_relations = 301
@@ -23,30 +31,50 @@ class PacketType(UniqueValueEnum):
     server_add_friend = 303
     server_remove_friend = 304
     server_send_message = 305
+    server_new_message = 306
+    server_relations_changed = 307
+    server_update_friends = 308
 
 
 class Packet(abc.ABC):
     def __init__(self, id: int | None = None) -> None:
-        if isinstance(id, int):
-            self.__id = id
-        else:
-            self.__id = int.from_bytes(
-                random.randbytes(SHARED_CONFIG["packets"]["packet_id_bytes"])
-            )
+        # packets without an id get one from the packet socket they are sent through
+        self.__id = id
+        # only sent for requests that are being traced
+        self.__trace_context: TraceContext | None = None
 
     def compile(self) -> bytes:
+        packet_type_value = self.type.value
+        trace_context_data = b""
+        if self.__trace_context != None:
+            packet_type_value |= TRACE_CONTEXT_FLAG
+            trace_context_data = self.__trace_context.to_bytes()
+
         return (
-            self.__id.to_bytes(SHARED_CONFIG["packets"]["packet_id_bytes"])
-            + self.type.value.to_bytes(SHARED_CONFIG["packets"]["packet_type_bytes"])
+            self.id.to_bytes(SHARED_CONFIG["packets"]["packet_id_bytes"])
+            + packet_type_value.to_bytes(SHARED_CONFIG["packets"]["packet_type_bytes"])
             + self.data_length.to_bytes(
                 SHARED_CONFIG["packets"]["packet_data_length_bytes"]
             )
+            + trace_context_data
             + self.compile_data()
         )
 
     @property
     def id(self) -> int:
-        return self.__id
+        return self.__id  # type: ignore
+
+    @id.setter
+    def id(self, id: int) -> None:
+        self.__id = id
+
+    @property
+    def trace_context(self) -> TraceContext | None:
+        return self.__trace_context
+
+    @trace_context.setter
+    def trace_context(self, trace_context: TraceContext | None) -> None:
+        self.__trace_context = trace_context
 
     @property
     def data_length(self) -> int:
@@ -98,6 +126,24 @@ class ClientPackets:
         def type(self) -> PacketType:
             return PacketType.client_authenticate
 
+    class ResumeSession(Packet):
+        def init_packet_from_params(self, resume_ticket: bytes) -> None:
+            self.__resume_ticket = resume_ticket
+
+        def init_packet_from_data(self, data: bytes) -> None:
+            self.__resume_ticket = bytes(data)
+
+        def compile_data(self) -> bytes:
+            return self.__resume_ticket
+
+        @property
+        def resume_ticket(self) -> bytes:
+            return self.__resume_ticket
+
+        @property
+        def type(self) -> PacketType:
+            return PacketType.client_resume_session
+
     class GetRelations(EmptyPacket):
         @property
         def type(self) -> PacketType:
@@ -174,11 +220,54 @@ class ClientPackets:
         def username(self) -> str:
             return self.__username
 
+    class UpdateFriends(Packet):
+        # adds (or accepts) or removes many friends at once
+        def init_packet_from_params(self, usernames: list[str], add: bool) -> None:
+            self.__usernames = usernames
+            self.__add = add
+
+        def init_packet_from_data(self, data: bytes) -> None:
+            self.__add = bool(data[0])
+            data = data[1:]
+
+            self.__usernames = []
+            i = 0
+            while i < len(data):
+                username_length = int.from_bytes(data[i : i + 2])
+                i += 2
+                self.__usernames.append(data[i : i + username_length].decode())
+                i += username_length
+
+        def compile_data(self) -> bytes:
+            output = bytearray()
+
+            output += b"\xFF" if self.__add else b"\x00"
+            for username in self.__usernames:
+                output += len(username.encode()).to_bytes(2)
+                output += username.encode()
+
+            return output
+
+        @property
+        def type(self) -> PacketType:
+            return PacketType.client_update_friends
+
+        @property
+        def usernames(self) -> list[str]:
+            return self.__usernames
+
+        @property
+        def add(self) -> bool:
+            return self.__add
+
     class SendMessage(Packet):
 
-        def init_packet_from_params(self, receiver: str, content: str) -> None:
+        def init_packet_from_params(
+            self, receiver: str, content: str, idempotency_key: bytes
+        ) -> None:
             self.__receiver = receiver
             self.__content = content
+            self.__idempotency_key = idempotency_key
 
         def init_packet_from_data(self, data: bytes) -> None:
             receiver_length = int.from_bytes(data[:2])
@@ -186,6 +275,11 @@ class ClientPackets:
             self.__receiver = data[:receiver_length].decode()
             data = data[receiver_length:]
 
+            self.__idempotency_key = bytes(
+                data[: SHARED_CONFIG["packets"]["idempotency_key_bytes"]]
+            )
+            data = data[SHARED_CONFIG["packets"]["idempotency_key_bytes"] :]
+
             self.__content = data.decode()
 
         def compile_data(self) -> bytes:
@@ -193,6 +287,7 @@ class ClientPackets:
 
             output_bytes += len(self.__receiver.encode()).to_bytes(2)
             output_bytes += self.__receiver.encode()
+            output_bytes += self.__idempotency_key
             output_bytes += self.__content.encode()
 
             return output_bytes
@@ -209,6 +304,10 @@ class ClientPackets:
         def content(self) -> str:
             return self.__content
 
+        @property
+        def idempotency_key(self) -> bytes:
+            return self.__idempotency_key
+
 
 # Shared packets
 class SharedPackets:
@@ -218,6 +317,16 @@ class SharedPackets:
         def type(self) -> PacketType:
             return PacketType.quit
 
+    class Ping(EmptyPacket):
+        @property
+        def type(self) -> PacketType:
+            return PacketType.ping
+
+    class Pong(EmptyPacket):
+        @property
+        def type(self) -> PacketType:
+            return PacketType.pong
+
     class InvalidPacketType(Packet):
         def init_packet_from_params(self, expected_types: list[PacketType]) -> None:
             self.__expected_types = expected_types
@@ -251,13 +360,23 @@ class SharedPackets:
 class ServerPackets:
 
     class Authenticate(Packet):
-        def init_packet_from_params(self, success: bool, username: str | None) -> None:
+        def init_packet_from_params(
+            self, success: bool, username: str | None, resume_ticket: bytes
+        ) -> None:
             self.__success = success
             self.__username = username
+            self.__resume_ticket = resume_ticket
 
         def init_packet_from_data(self, data: bytes) -> None:
             self.__success = bool(data[0])
-            self.__username = data[1:].decode()
+            data = data[1:]
+
+            username_length = int.from_bytes(data[:2])
+            data = data[2:]
+            self.__username = data[:username_length].decode()
+            data = data[username_length:]
+
+            self.__resume_ticket = bytes(data)
 
         def compile_data(self) -> bytes:
             output_data = bytearray()
@@ -266,8 +385,10 @@ class ServerPackets:
                 output_data += b"\xFF"
             else:
                 output_data += b"\x00"
-            if self.__username != None:
-                output_data += self.__username.encode()
+            username = self.__username if self.__username != None else ""
+            output_data += len(username.encode()).to_bytes(2)
+            output_data += username.encode()
+            output_data += self.__resume_ticket
 
             return output_data
 
@@ -279,6 +400,10 @@ class ServerPackets:
         def username(self) -> str | None:
             return self.__username
 
+        @property
+        def resume_ticket(self) -> bytes:
+            return self.__resume_ticket
+
         @property
         def type(self) -> PacketType:
             return PacketType.server_authenticate
@@ -290,25 +415,24 @@ class ServerPackets:
         def init_packet_from_data(self, data: bytes) -> None:
             self.__relations = []
 
-            while len(data) > 0:
-                first_username_length = int.from_bytes(data[:2])
-                data = data[2:]
-                first_username = data[:first_username_length].decode()
-                data = data[first_username_length:]
-
-                secondary_username_length = int.from_bytes(data[:2])
-                data = data[2:]
-                secondary_username = data[:secondary_username_length].decode()
-                data = data[secondary_username_length:]
-
-                first_is_friend = bool(data[0])
-                data = data[1:]
+            # an offset instead of slicing off the front, which would copy the rest
+            # of the data for every relation
+            i = 0
+            while i < len(data):
+                first_username_length = int.from_bytes(data[i : i + 2])
+                i += 2
+                first_username = data[i : i + first_username_length].decode()
+                i += first_username_length
 
-                secondary_is_friend = bool(data[0])
-                data = data[1:]
+                secondary_username_length = int.from_bytes(data[i : i + 2])
+                i += 2
+                secondary_username = data[i : i + secondary_username_length].decode()
+                i += secondary_username_length
 
-                secondary_is_blocked = bool(data[0])
-                data = data[1:]
+                first_is_friend = bool(data[i])
+                secondary_is_friend = bool(data[i + 1])
+                secondary_is_blocked = bool(data[i + 2])
+                i += 3
 
                 self.__relations.append(
                     Relation(
@@ -349,31 +473,40 @@ class ServerPackets:
         def init_packet_from_data(self, data: bytes) -> None:
             self.__messages = []
 
-            while len(data) > 0:
-                sender_length = int.from_bytes(data[:2])
-                data = data[2:]
-                sender = data[:sender_length].decode()
-                data = data[sender_length:]
+            # an offset instead of slicing off the front, which would copy the rest
+            # of the data for every message
+            i = 0
+            while i < len(data):
+                message_id = int.from_bytes(data[i : i + 8])
+                i += 8
 
-                receiver_length = int.from_bytes(data[:2])
-                data = data[2:]
-                receiver = data[:receiver_length].decode()
-                data = data[receiver_length:]
+                sender_length = int.from_bytes(data[i : i + 2])
+                i += 2
+                sender = data[i : i + sender_length].decode()
+                i += sender_length
 
-                time_sent = int.from_bytes(data[:8])
-                data = data[8:]
+                receiver_length = int.from_bytes(data[i : i + 2])
+                i += 2
+                receiver = data[i : i + receiver_length].decode()
+                i += receiver_length
 
-                content_length = int.from_bytes(data[:8])
-                data = data[8:]
-                content = data[:content_length].decode()
-                data = data[content_length:]
+                time_sent = int.from_bytes(data[i : i + 8])
+                i += 8
 
-                self.__messages.append(Message(sender, receiver, time_sent, content))
+                content_length = int.from_bytes(data[i : i + 8])
+                i += 8
+                content = data[i : i + content_length].decode()
+                i += content_length
+
+                self.__messages.append(
+                    Message(message_id, sender, receiver, time_sent, content)
+                )
 
         def compile_data(self) -> bytes:
             output = bytearray()
 
             for message in self.__messages:
+                output += message.id.to_bytes(8)
                 output += len(message.sender.encode()).to_bytes(2)
                 output += message.sender.encode()
                 output += len(message.receiver.encode()).to_bytes(2)
@@ -392,6 +525,18 @@ class ServerPackets:
         def messages(self) -> list[Message]:
             return self.__messages
 
+    class NewMessage(GetMessages):
+        # pushed without a request, to every session of the sender and the receiver
+        @property
+        def type(self) -> PacketType:
+            return PacketType.server_new_message
+
+    class RelationsChanged(EmptyPacket):
+        # pushed without a request, to every session of both users of the relation
+        @property
+        def type(self) -> PacketType:
+            return PacketType.server_relations_changed
+
     class AddFriend(Packet):
         def init_packet_from_params(self, success: bool) -> None:
             self.__success = success
@@ -415,11 +560,45 @@ class ServerPackets:
         def type(self) -> PacketType:
             return PacketType.server_remove_friend
 
-    class SendMessage(EmptyPacket):
+    class UpdateFriends(Packet):
+        # whether each of the usernames in the request was updated, in the same order
+        def init_packet_from_params(self, results: list[bool]) -> None:
+            self.__results = results
+
+        def init_packet_from_data(self, data: bytes) -> None:
+            self.__results = [bool(result) for result in data]
+
+        def compile_data(self) -> bytes:
+            return b"".join(
+                [b"\xFF" if result else b"\x00" for result in self.__results]
+            )
+
+        @property
+        def type(self) -> PacketType:
+            return PacketType.server_update_friends
+
+        @property
+        def results(self) -> list[bool]:
+            return self.__results
+
+    class SendMessage(Packet):
+        def init_packet_from_params(self, message_id: int) -> None:
+            self.__message_id = message_id
+
+        def init_packet_from_data(self, data: bytes) -> None:
+            self.__message_id = int.from_bytes(data)
+
+        def compile_data(self) -> bytes:
+            return self.__message_id.to_bytes(8)
+
         @property
         def type(self) -> PacketType:
             return PacketType.server_send_message
 
+        @property
+        def message_id(self) -> int:
+            return self.__message_id
+
 
 PACKET_TYPE_TO_CLASS: dict[PacketType, type[Packet]] = {
     # Client packets
@@ -429,9 +608,13 @@ PACKET_TYPE_TO_CLASS: dict[PacketType, type[Packet]] = {
     PacketType.client_add_friend: ClientPackets.AddFriend,
     PacketType.client_remove_friend: ClientPackets.RemoveFriend,
     PacketType.client_send_message: ClientPackets.SendMessage,
+    PacketType.client_resume_session: ClientPackets.ResumeSession,
+    PacketType.client_update_friends: ClientPackets.UpdateFriends,
     # Shared packets
     PacketType.quit: SharedPackets.Quit,
     PacketType.invalid_packet_type: SharedPackets.InvalidPacketType,
+    PacketType.ping: SharedPackets.Ping,
+    PacketType.pong: SharedPackets.Pong,
     # Server packets
     PacketType.server_authenticate: ServerPackets.Authenticate,
     PacketType.server_get_relations: ServerPackets.GetRelations,
@@ -439,6 +622,9 @@ PACKET_TYPE_TO_CLASS: dict[PacketType, type[Packet]] = {
     PacketType.server_add_friend: ServerPackets.AddFriend,
     PacketType.server_remove_friend: ServerPackets.RemoveFriend,
     PacketType.server_send_message: ServerPackets.SendMessage,
+    PacketType.server_new_message: ServerPackets.NewMessage,
+    PacketType.server_relations_changed: ServerPackets.RelationsChanged,
+    PacketType.server_update_friends: ServerPackets.UpdateFriends,
 }
 
 PACKET_CLASS_TO_TYPE = {
@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import dataclasses
+import threading
+import random
+import json
+import time
+import os
+
+
+TRACE_ID_BYTES = 8
+SPAN_ID_BYTES = 8
+TRACE_CONTEXT_BYTES = TRACE_ID_BYTES + SPAN_ID_BYTES
+
+
+@dataclasses.dataclass(frozen=True)
+class TraceContext:
+    # what a span hands to the spans under it, also in other threads and over the network
+    trace_id: bytes
+    span_id: bytes
+
+    def to_bytes(self) -> bytes:
+        return self.trace_id + self.span_id
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        return cls(data[:TRACE_ID_BYTES], data[TRACE_ID_BYTES:])
+
+
+# the span the current thread is in
+_current_trace_context: contextvars.ContextVar[TraceContext | None] = (
+    contextvars.ContextVar("current_trace_context", default=None)
+)
+
+
+def get_current_trace_context() -> TraceContext | None:
+    return _current_trace_context.get()
+
+
+class Span:
+    def __init__(
+        self,
+        tracer: Tracer,
+        name: str,
+        context: TraceContext,
+        parent_span_id: bytes | None,
+        attributes: dict,
+    ) -> None:
+        self.__tracer = tracer
+        self.__name = name
+        self.__context = context
+        self.__parent_span_id = parent_span_id
+        self.__attributes = attributes
+        self.__start_time = time.time()
+        self.__start_counter = time.perf_counter()
+        # spans can end in another thread than the one they started in
+        self.__thread_name = threading.current_thread().name
+
+    def end(self) -> None:
+        self.__tracer.write_span(
+            {
+                "trace_id": self.__context.trace_id.hex(),
+                "span_id": self.__context.span_id.hex(),
+                "parent_span_id": (
+                    self.__parent_span_id.hex()
+                    if self.__parent_span_id != None
+                    else None
+                ),
+                "name": self.__name,
+                "start": self.__start_time,
+                "duration": time.perf_counter() - self.__start_counter,
+                "thread": self.__thread_name,
+                "attributes": self.__attributes,
+            }
+        )
+
+    @property
+    def context(self) -> TraceContext:
+        return self.__context
+
+
+class Tracer:
+    # writes every finished span as a json line, traces only start from the spans made
+    # with root=True, everything else only joins a trace it's already in
+    def __init__(self) -> None:
+        self.__file = None
+        self.__sample_rate = 1.0
+        self.__lock = threading.Lock()
+
+    def configure(self, filepath: str | None, sample_rate: float = 1.0) -> None:
+        # None turns it off
+        with self.__lock:
+            if self.__file != None:
+                self.__file.close()
+                self.__file = None
+            if filepath != None:
+                os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+                # line buffered, so a crash doesn't lose the spans before it
+                self.__file = open(filepath, "a", buffering=1)
+        self.__sample_rate = sample_rate
+
+    @property
+    def enabled(self) -> bool:
+        return self.__file != None
+
+    def start_span(
+        self,
+        name: str,
+        parent: TraceContext | None = None,
+        root: bool = False,
+        **attributes,
+    ) -> Span | None:
+        # None when it isn't traced, which is always the case while tracing is off
+        if self.__file == None:
+            return None
+        if parent == None:
+            parent = _current_trace_context.get()
+        if parent == None and (not root or random.random() >= self.__sample_rate):
+            return None
+
+        return Span(
+            self,
+            name,
+            TraceContext(
+                parent.trace_id if parent != None else os.urandom(TRACE_ID_BYTES),
+                os.urandom(SPAN_ID_BYTES),
+            ),
+            parent.span_id if parent != None else None,
+            attributes,
+        )
+
+    @contextlib.contextmanager
+    def span(
+        self,
+        name: str,
+        parent: TraceContext | None = None,
+        root: bool = False,
+        **attributes,
+    ):
+        # the spans started inside of it (in the same thread) are under it
+        span = self.start_span(name, parent, root, **attributes)
+        if span == None:
+            yield None
+            return
+
+        token = _current_trace_context.set(span.context)
+        try:
+            yield span
+        finally:
+            _current_trace_context.reset(token)
+            span.end()
+
+    def write_span(self, span: dict) -> None:
+        line = json.dumps(span) + "\n"
+        with self.__lock:
+            if self.__file != None:
+                self.__file.write(line)
+
+
+# shared by everything in the process, configured at startup
+TRACER = Tracer()
@@ -0,0 +1,40 @@
+from shared.config import SERVER_CONFIG
+from server.db_handler import DBWrapper
+
+import pytest
+import os
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setitem(
+        SERVER_CONFIG["database"], "filepath", str(tmp_path / "database.db")
+    )
+    # a session still holding the write lock makes the others fail fast
+    monkeypatch.setitem(SERVER_CONFIG["database"], "connect_timeout", 0.5)
+    DBWrapper().ensure_tables()
+
+
+def test_retried_message_returns_the_first_one(database):
+    db_wrapper = DBWrapper()
+    idempotency_key = os.urandom(16)
+
+    message, added = db_wrapper.add_message("alice", "bob", "hi", idempotency_key)
+    retried_message, retried_added = db_wrapper.add_message(
+        "alice", "bob", "hi", idempotency_key
+    )
+
+    assert added and not retried_added
+    assert retried_message == message
+
+
+def test_other_session_can_write_after_a_retried_message(database):
+    first_db_wrapper = DBWrapper()
+    second_db_wrapper = DBWrapper()
+    idempotency_key = os.urandom(16)
+
+    first_db_wrapper.add_message("alice", "bob", "hi", idempotency_key)
+    first_db_wrapper.add_message("alice", "bob", "hi", idempotency_key)
+
+    _, added = second_db_wrapper.add_message("bob", "alice", "hey", os.urandom(16))
+    assert added